@@ -6,24 +6,54 @@
 ملاحظة: هذا تطبيق تعريفي - لتحويله للإنتاج ستحتاج لإضافة مصادقة قوية، صلاحيات، واختبارات.
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session, g, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_wtf import CSRFProtect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_compress import Compress
-from datetime import datetime, timedelta, timezone
-import csv, io, json, os, secrets
-from openpyxl import Workbook
+from sqlalchemy import event, insert, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import object_session, raiseload, selectinload
+from datetime import date, datetime, timedelta, timezone
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import atexit, codecs, hashlib, io, json, mimetypes, os, queue, secrets, sqlite3, tempfile, threading, time, unicodedata
+from cachetools import TTLCache, cached
+import numpy as np
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from urllib.parse import quote
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import NotFound
+from werkzeug.security import check_password_hash, safe_join
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from jinja2 import FileSystemBytecodeCache
 from pymongo import MongoClient
 import re
 
+# Argon2id لتجزئة كلمات المرور - كائن واحد آمن للاستخدام من عدة خيوط
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+ARGON2_PREFIX = '$argon2'
+
+# Numba اختياري - يسرّع إعادة احتساب العمولات على أعداد كبيرة من الدفعات إن كان مثبتاً
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
 app = Flask(__name__)
 
+# Templates - القوالب المترجمة تُحفظ على القرص فيعيد العمال الجدد استخدامها بدلاً من تحليلها مجدداً
+# (المجلد الافتراضي لـ Jinja خاص بالمستخدم الحالي وينشأ عند أول استخدام)
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
 # Compression
+# Streamed responses (CSV export) go out as they are generated; compressing them would buffer the whole body
+app.config['COMPRESS_STREAMS'] = False
 compress = Compress(app)
 
 # Security Configuration
@@ -33,6 +63,8 @@ app.config['SESSION_COOKIE_SECURE'] = True
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=2)
+SESSION_IDLE_TIMEOUT = 2 * 60 * 60  # seconds of inactivity before forced logout
+SESSION_ACTIVITY_RESOLUTION = 60  # seconds between last_activity refreshes in the session cookie
 
 # Database Configuration - Railway provides DATABASE_URL
 database_url = os.environ.get('DATABASE_URL')
@@ -43,10 +75,45 @@ else:
     # Fallback for local development
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///kthaib_new.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# فحص الاتصال قبل استخدامه من المجمع (يتجنب أخطاء الاتصالات المنقطعة على PostgreSQL)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True}
+if database_url:
+    # حجم المجمع لكل عامل: خيوط الطلب + التصدير في الخلفية
+    # LIFO يعيد استخدام أحدث اتصال فتُغلق الاتصالات الزائدة بعد انتهاء الضغط
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_recycle=1800,
+        pool_use_lifo=True,
+    )
 
 # File Upload Configuration
 app.config['UPLOAD_FOLDER'] = 'uploads/contracts'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB read/write buffer for contract uploads
+MAX_CONTRACT_SIZE = 10 * 1024 * 1024  # 10MB limit for contracts
+# Optional nginx internal location for contracts, e.g. '/protected/contracts/'
+# When set, downloads are handed to nginx via X-Accel-Redirect instead of being read by Python
+app.config['CONTRACTS_ACCEL_REDIRECT'] = os.environ.get('CONTRACTS_ACCEL_REDIRECT')
+CONTRACT_STREAM_BUFSIZE = 128 * 1024  # read size when the server streams contracts itself (no sendfile)
+CONTRACT_CACHE_MAX_AGE = 24 * 60 * 60  # seconds the browser may reuse a contract without revalidating
+# أنواع العقود التي يمكن عرضها مباشرة في المتصفح
+CONTRACT_MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif'
+}
+VIEWABLE_CONTRACT_EXTS = frozenset(CONTRACT_MIME_TYPES)
+
+# Export Configuration
+EXPORT_BATCH_SIZE = 1000  # عدد الصفوف المقروءة من قاعدة البيانات في كل دفعة أثناء التصدير
+EXPORT_CHUNK_BYTES = 64 * 1024  # حجم الجزء المرسل للعميل أثناء بث ملف CSV
+# ملفات Excel المولدة في الخلفية - مشتركة بين عمال gunicorn عبر القرص
+app.config['EXPORT_FOLDER'] = os.path.join(tempfile.gettempdir(), 'kathib_exports')
+EXPORT_CACHE_TTL = 300  # ثواني - نفس الفلاتر دون تعديل على البيانات تعيد استخدام الملف الجاهز خلال هذه المدة
+export_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='export')
 
 # Security Headers
 app.config['SECURITY_HEADERS'] = {
@@ -56,15 +123,28 @@ app.config['SECURITY_HEADERS'] = {
     'Strict-Transport-Security': 'max-age=31536000; includeSubDomains',
     'Content-Security-Policy': "default-src 'self'; script-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net https://cdnjs.cloudflare.com; style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net https://fonts.googleapis.com; font-src 'self' https://fonts.gstatic.com https://fonts.googleapis.com; img-src 'self' data: https:; connect-src 'self'"
 }
+# أزواج الترويسات تُجهز مرة واحدة بدلاً من قراءة الإعدادات مع كل استجابة
+SECURITY_HEADERS_ITEMS = tuple(app.config['SECURITY_HEADERS'].items())
 
 # MongoDB Configuration
+# MongoClient يتصل بشكل كسول، وفحص الاتصال يتم في خيط خلفي حتى لا يتأخر إقلاع العمال
 MONGODB_URL = os.environ.get('MONGODB_URL')
+MONGO_SEED_WAIT = 5  # ثوانٍ لانتظار فحص الاتصال قبل تهيئة البيانات
+mongo_ready = threading.Event()
+
+def _init_mongo():
+    try:
+        mongo_client.admin.command('ping')  # Test connection
+        mongo_ready.set()
+        print("MongoDB connected successfully")
+    except Exception as e:
+        print(f"MongoDB connection failed: {e}")
+
 if MONGODB_URL:
     try:
         mongo_client = MongoClient(MONGODB_URL, serverSelectionTimeoutMS=5000)
-        mongo_client.admin.command('ping')  # Test connection
         mongo_db = mongo_client['kthaib_db']
-        print("MongoDB connected successfully")
+        threading.Thread(target=_init_mongo, name='mongo-ping', daemon=True).start()
     except Exception as e:
         print(f"MongoDB connection failed: {e}")
         mongo_client = None
@@ -76,14 +156,40 @@ else:
 
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL journaling and memory-friendly pragmas for SQLite connections (no effect on PostgreSQL)"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA mmap_size=268435456')  # 256 MiB
+        cursor.execute('PRAGMA cache_size=-65536')  # 64 MiB
+        cursor.close()
+
 # CSRF Protection
 csrf = CSRFProtect(app)
 
 # Rate Limiting
+# Counters are shared across gunicorn workers when RATELIMIT_STORAGE_URI points at
+# Redis/Memcached (e.g. redis://host:6379/0, needs the redis package); in-memory otherwise
+RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
+# fixed-window costs a single INCR/EXPIRE per hit; moving-window is more exact but runs a
+# Lua script over a list per hit, so it is opt-in via RATELIMIT_STRATEGY
+RATELIMIT_STRATEGY = os.environ.get('RATELIMIT_STRATEGY', 'fixed-window')
+# Redis connections are pooled by the client; keep them alive instead of reconnecting
+RATELIMIT_STORAGE_OPTIONS = (
+    {'socket_keepalive': True, 'health_check_interval': 30}
+    if RATELIMIT_STORAGE_URI.startswith(('redis://', 'rediss://')) else {}
+)
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
-    default_limits=["10000 per day", "1000 per hour"]
+    default_limits=["10000 per day", "1000 per hour"],
+    storage_uri=RATELIMIT_STORAGE_URI,
+    storage_options=RATELIMIT_STORAGE_OPTIONS,
+    strategy=RATELIMIT_STRATEGY
 )
 
 # Flask-Login setup
@@ -106,24 +212,40 @@ def check_session_timeout():
     """Check for session timeout and enforce it"""
     if current_user.is_authenticated:
         # Check if session has expired (2 hours of inactivity)
+        now = int(time.time())
         last_activity = session.get('last_activity')
+        if isinstance(last_activity, str):
+            # Sessions issued before the switch to unix timestamps stored an ISO string
+            last_activity = int(datetime.fromisoformat(last_activity).replace(tzinfo=timezone.utc).timestamp())
         if last_activity:
-            last_activity_time = datetime.fromisoformat(last_activity).replace(tzinfo=timezone.utc)
-            if datetime.now(timezone.utc) - last_activity_time > timedelta(hours=2):
+            if now - last_activity > SESSION_IDLE_TIMEOUT:
                 logout_user()
                 flash('انتهت صلاحية الجلسة بسبب عدم النشاط. يرجى تسجيل الدخول مرة أخرى.', 'info')
                 return redirect(url_for('login'))
 
-        # Update last activity time
-        session['last_activity'] = datetime.now(timezone.utc).isoformat()
+        # Update last activity time - only when it moved enough, so the cookie isn't re-signed on every request
+        if not last_activity or now - last_activity >= SESSION_ACTIVITY_RESOLUTION:
+            session['last_activity'] = now
+
+@app.before_request
+def cache_user_identity():
+    """Read the logged-in user's role and names once per request into g"""
+    # Later reads don't go back through the current_user proxy, and don't re-SELECT
+    # the user after a commit has expired it
+    if current_user.is_authenticated:
+        g.user_role = current_user.role
+        g.user_name = current_user.name
+        g.username = current_user.username
+    else:
+        g.user_role = g.user_name = g.username = None
 
 # Security Headers
 @app.after_request
 def add_security_headers(response):
     """Add security headers to all responses"""
-    headers = app.config.get('SECURITY_HEADERS', {})
-    for header, value in headers.items():
-        response.headers[header] = value
+    set_header = response.headers.set
+    for header, value in SECURITY_HEADERS_ITEMS:
+        set_header(header, value)
     return response
 
 # HTTPS Enforcement
@@ -135,16 +257,20 @@ def enforce_https():
         return redirect(url, code=301)
 
 # Input Validation Functions
+# Patterns compiled once at import instead of going through re's cache on every call
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+# Saudi phone numbers: 05xxxxxxxx or +9665xxxxxxxx
+PHONE_RE = re.compile(r'^(\+966|0)?5[0-9]{8}$')
+SANITIZE_RE = re.compile(r'[<>]')
+ALLOWED_EXTENSIONS = frozenset({'pdf', 'doc', 'docx', 'jpg', 'jpeg', 'png', 'gif'})
+
 def validate_email(email):
     """Validate email format"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return EMAIL_RE.match(email) is not None
 
 def validate_phone(phone):
     """Validate Saudi phone number format"""
-    # Saudi phone numbers: 05xxxxxxxx or +9665xxxxxxxx
-    pattern = r'^(\+966|0)?5[0-9]{8}$'
-    return re.match(pattern, phone) is not None
+    return PHONE_RE.match(phone) is not None
 
 def validate_national_id(national_id):
     """Validate Saudi National ID format"""
@@ -156,13 +282,103 @@ def sanitize_input(text):
     if not text:
         return text
     # Remove potentially dangerous characters
-    return re.sub(r'[<>]', '', str(text).strip())
+    return SANITIZE_RE.sub('', str(text).strip())
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
-    ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'jpg', 'jpeg', 'png', 'gif'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+class FormError(ValueError):
+    """Raised when submitted form data cannot be parsed"""
+
+def optional_int(value):
+    return int(value) if value else None
+
+class PaymentForm(namedtuple('PaymentForm', 'unit_id payer_type payer_id amount company_rate vat_rate payment_date description')):
+    """Payment form fields parsed once (tuple subclass, no per-instance __dict__)"""
+    __slots__ = ()
+
+    @classmethod
+    def from_form(cls, form, default_date=None):
+        """Parse and coerce the payment form; raises FormError on invalid input"""
+        get = form.get
+        payment_date = get('payment_date')
+        try:
+            return cls(
+                unit_id=int(get('unit_id')),
+                payer_type=get('payer_type'),
+                payer_id=optional_int(get('payer_id')),
+                amount=float(get('amount') or 0),
+                company_rate=float(get('company_rate') or 0.05),
+                vat_rate=float(get('vat_rate') or 0.15),
+                payment_date=datetime.fromisoformat(payment_date) if payment_date else default_date,
+                description=get('description'),
+            )
+        except (TypeError, ValueError):
+            raise FormError('خطأ في البيانات المدخلة.')
+
+class UnitForm(namedtuple('UnitForm', 'project_id unit_number type area owner_id tenant_id status')):
+    """Unit form fields parsed once (tuple subclass, no per-instance __dict__)"""
+    __slots__ = ()
+
+    @classmethod
+    def from_form(cls, form):
+        """Parse and coerce the unit form; raises FormError on invalid input"""
+        get = form.get
+        unit_number = get('unit_number')
+        area = get('area')
+        try:
+            return cls(
+                project_id=optional_int(get('project_id')),
+                unit_number=unit_number.strip() if unit_number else unit_number,
+                type=get('type'),
+                area=float(area) if area else None,
+                owner_id=optional_int(get('owner_id')),
+                tenant_id=optional_int(get('tenant_id')),
+                status=get('status'),
+            )
+        except (TypeError, ValueError):
+            raise FormError('خطأ في البيانات المدخلة.')
+
+def save_contract_file(file):
+    """Save an uploaded contract under a content-addressed name (SHA-256) and return the filename
+
+    Raises FormError if the upload is larger than MAX_CONTRACT_SIZE.
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    # Ensure upload directory exists
+    os.makedirs(upload_folder, exist_ok=True)
+
+    # Hash and write in the same pass through a 1MB buffer; the final name is known only
+    # once the whole upload is hashed, so write to a temporary file next to it first
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb', buffering=UPLOAD_CHUNK_SIZE) as out:
+            size = 0
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                # Stop as soon as the limit is crossed instead of measuring the upload first
+                size += len(chunk)
+                if size > MAX_CONTRACT_SIZE:
+                    raise FormError('حجم الملف كبير جداً. الحد الأقصى 10 ميجابايت.')
+                digest.update(chunk)
+                out.write(chunk)
+
+        filename = f"{digest.hexdigest()[:16]}_{secure_filename(file.filename)}"
+        file_path = os.path.join(upload_folder, filename)
+
+        # Identical files map to the same name, so they are stored once
+        if os.path.exists(file_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return filename
+
 # -------------------------
 # نماذج البيانات (Models)
 # -------------------------
@@ -205,19 +421,42 @@ class Tenant(db.Model):
 
 class Project(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(150), nullable=False)
+    name = db.Column(db.String(150), nullable=False, index=True)  # فحص تكرار الاسم عند الإضافة
     location = db.Column(db.String(150))
     description = db.Column(db.Text)
+    units = db.relationship('Unit', back_populates='project', lazy=True)
+
+# نص البحث في المشاريع كتعبير واحد بدلاً من ثلاثة شروط LIKE مربوطة بـ OR
+# الفواصل حرفية (وليست معاملات) ليطابق التعبير فهرس الـ trigram في PostgreSQL حرفياً
+# الفاصل '|' يُحذف من نص البحث، فلا تطابق كلمة تمتد عبر حقلين
+PROJECT_SEARCH_SEPARATOR = '|'
+project_search_text = (
+    Project.name + db.literal_column(f"'{PROJECT_SEARCH_SEPARATOR}'")
+    + db.func.coalesce(Project.location, db.literal_column("''")) + db.literal_column(f"'{PROJECT_SEARCH_SEPARATOR}'")
+    + db.func.coalesce(Project.description, db.literal_column("''"))
+)
+PROJECT_SEARCH_TRGM_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_project_search_trgm ON project USING gin "
+    f"((name || '{PROJECT_SEARCH_SEPARATOR}' || coalesce(location, '') || '{PROJECT_SEARCH_SEPARATOR}' "
+    "|| coalesce(description, '')) gin_trgm_ops)"
+)
 
 class Unit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False, index=True)
     unit_number = db.Column(db.String(50))
     type = db.Column(db.String(50))
     area = db.Column(db.Float)
-    owner_id = db.Column(db.Integer, db.ForeignKey('owner.id'), nullable=True)
-    tenant_id = db.Column(db.Integer, db.ForeignKey('tenant.id'), nullable=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('owner.id'), nullable=True, index=True)
+    tenant_id = db.Column(db.Integer, db.ForeignKey('tenant.id'), nullable=True, index=True)
     status = db.Column(db.String(50), default='available')
+    project = db.relationship('Project', back_populates='units')
+    payments = db.relationship('Payment', back_populates='unit', lazy=True)
+
+    # فلتر الحالة في صفحة المشاريع (مع المشروع أو بدونه)
+    __table_args__ = (
+        db.Index('ix_unit_status_project', 'status', 'project_id'),
+    )
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -235,11 +474,86 @@ class Payment(db.Model):
     vat_on_commission = db.Column(db.Float)
     net_to_owner = db.Column(db.Float)
 
+    unit = db.relationship('Unit', back_populates='payments')
+
+    # فهارس لفلاتر التقارير (نطاق التاريخ، نوع الدافع) والربط بالوحدات
+    __table_args__ = (
+        db.Index('ix_payment_date_payer', 'date', 'payer_type'),
+        # ترتيب وتقسيم صفحات الدفعات على (date, id)
+        db.Index('ix_payment_date_id', 'date', 'id'),
+        # يغطي الفلترة حسب نوع الدافع وحده وكذلك البحث عن دفعات مالك/مستأجر محدد
+        db.Index('ix_payment_payer', 'payer_type', 'payer_id'),
+        db.Index('ix_payment_unit', 'unit_id'),
+    )
+
+# PostgreSQL: فهرس trigram لبحث الوصف (ILIKE '%...%') في صفحة الدفعات
+PAYMENT_DESCRIPTION_TRGM_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_payment_description_trgm ON payment USING gin (description gin_trgm_ops)"
+)
+
 class AuditLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     action = db.Column(db.String(255))
     user = db.Column(db.String(80))
-    timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)  # آخر السجلات في لوحة التحكم
+
+# سجلات تسجيل الدخول لا ترتبط بتعديل بيانات، فتُكتب على دفعات من خيط خلفي بدلاً من داخل الطلب
+# (سجلات التعديلات تبقى في نفس معاملة التعديل)
+AUDIT_FLUSH_INTERVAL = 0.5  # ثوانٍ لتجميع السجلات قبل كتابتها
+AUDIT_BATCH_SIZE = 500
+audit_queue = queue.Queue()
+audit_writer_lock = threading.Lock()
+audit_writer_pid = None  # الخيوط لا تنتقل مع fork، لذا يبدأ كل عامل خيطه عند أول استخدام
+
+def write_audit_rows(rows):
+    """إدراج مجموعة سجلات تدقيق بعبارة INSERT واحدة (executemany)"""
+    try:
+        with app.app_context():
+            db.session.execute(insert(AuditLog), rows)
+            db.session.commit()
+    except Exception as e:
+        print(f"Audit log write failed: {e}")
+
+def audit_writer():
+    while True:
+        rows = [audit_queue.get()]
+        deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+        while len(rows) < AUDIT_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(audit_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        write_audit_rows(rows)
+
+def queue_audit(action, user):
+    """إضافة سجل تدقيق إلى طابور الكتابة الخلفية"""
+    global audit_writer_pid
+    if audit_writer_pid != os.getpid():
+        with audit_writer_lock:
+            if audit_writer_pid != os.getpid():
+                threading.Thread(target=audit_writer, name='audit-writer', daemon=True).start()
+                audit_writer_pid = os.getpid()
+    audit_queue.put_nowait({'action': action, 'user': user, 'timestamp': datetime.now(timezone.utc)})
+
+@atexit.register
+def flush_audit_queue():
+    """كتابة ما تبقى في الطابور عند إيقاف العامل"""
+    rows = []
+    while True:
+        try:
+            rows.append(audit_queue.get_nowait())
+        except queue.Empty:
+            break
+    if rows:
+        write_audit_rows(rows)
+
+LOGIN_MAX_ATTEMPTS = 5
+LOGIN_LOCK_SECONDS = 30 * 60  # Lock for 30 minutes
+# The failed-login counter only moves to the rate-limit storage when every worker shares it
+LOGIN_COUNTER_SHARED = not RATELIMIT_STORAGE_URI.startswith('memory://')
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -260,10 +574,26 @@ class User(UserMixin, db.Model):
         # Password strength validation
         if not self.validate_password_strength(password):
             raise ValueError('كلمة المرور ضعيفة. يجب أن تحتوي على 8 أحرف على الأقل، حرف كبير، حرف صغير، ورقم.')
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify a password against an Argon2id or legacy Werkzeug hash.
+
+        Legacy hashes and hashes with outdated Argon2 parameters are upgraded
+        in place; the caller's next commit persists the new hash.
+        """
+        if not self.password_hash.startswith(ARGON2_PREFIX):
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.password_hash = password_hasher.hash(password)
+            return True
+        try:
+            password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if password_hasher.check_needs_rehash(self.password_hash):
+            self.password_hash = password_hasher.hash(password)
+        return True
 
     def validate_password_strength(self, password):
         """Validate password strength requirements"""
@@ -277,29 +607,58 @@ class User(UserMixin, db.Model):
             return False
         return True
 
+    def lock_remaining(self):
+        """Return the remaining lock time, or None if the account is not locked"""
+        if not self.locked_until:
+            return None
+        locked_until = self.locked_until
+        if locked_until.tzinfo is None:  # SQLite returns naive UTC datetimes
+            locked_until = locked_until.replace(tzinfo=timezone.utc)
+        remaining = locked_until - datetime.now(timezone.utc)
+        return remaining if remaining > timedelta(0) else None
+
     def is_account_locked(self):
         """Check if account is currently locked"""
-        if self.locked_until and datetime.utcnow() < self.locked_until:
-            return True
-        return False
+        return self.lock_remaining() is not None
 
     def increment_login_attempts(self):
-        """Increment login attempts and lock account if necessary"""
-        self.login_attempts += 1
-        if self.login_attempts >= 5:  # Lock after 5 failed attempts
-            self.locked_until = datetime.utcnow() + timedelta(minutes=30)  # Lock for 30 minutes
-        db.session.commit()
+        """Count a failed login and lock the account if necessary (the caller commits)
+
+        With a shared rate-limit storage the counter lives there (atomic INCR with
+        expiry), so a failed attempt only writes to the database when it locks the
+        account. The in-memory storage is per worker, so the counter then stays in
+        the database and is bumped with a single atomic UPDATE.
+        """
+        lock_time = datetime.now(timezone.utc) + timedelta(seconds=LOGIN_LOCK_SECONDS)
+        if LOGIN_COUNTER_SHARED:
+            attempts = limiter.storage.incr(f"login_fail/{self.id}", LOGIN_LOCK_SECONDS)
+            if attempts >= LOGIN_MAX_ATTEMPTS:
+                self.login_attempts = attempts
+                self.locked_until = lock_time
+            return attempts
+
+        attempts = db.func.coalesce(User.login_attempts, 0) + 1
+        return db.session.execute(
+            update(User)
+            .where(User.id == self.id)
+            .values(
+                login_attempts=attempts,
+                locked_until=db.case((attempts >= LOGIN_MAX_ATTEMPTS, lock_time), else_=User.locked_until),
+            )
+            .returning(User.login_attempts)
+            .execution_options(synchronize_session=False)
+        ).scalar_one()
 
     def reset_login_attempts(self):
-        """Reset login attempts on successful login"""
+        """Reset login attempts on successful login (the caller commits)"""
+        if LOGIN_COUNTER_SHARED:
+            limiter.storage.clear(f"login_fail/{self.id}")
         self.login_attempts = 0
         self.locked_until = None
         self.last_login = datetime.now(timezone.utc)
-        db.session.commit()
 
     def generate_reset_token(self):
         """Generate password reset token"""
-        import secrets
         self.password_reset_token = secrets.token_urlsafe(32)
         self.password_reset_expires = datetime.now(timezone.utc) + timedelta(hours=1)
         db.session.commit()
@@ -323,292 +682,552 @@ def calculate_payment_breakdown(amount, company_rate, vat_rate, commission_deduc
     netToOwner = round(amount - companyCommission - vatOnCommission, 2)
     return companyCommission, vatOnCommission, netToOwner
 
+def _round_cents(values):
+    """
+    تقريب إلى خانتين عشريتين كما يفعل np.round، مع تحديد القيم التي وقعت بالضبط
+    على منتصف الهللة بعد الضرب في 100 - وهي الحالة الوحيدة التي قد يختلف فيها
+    np.round (تقريب للزوجي) عن round في بايثون (تقريب دقيق للقيمة الثنائية).
+    """
+    scaled = values * 100.0
+    return np.rint(scaled) / 100.0, (scaled - np.floor(scaled)) == 0.5
+
+if NUMBA_AVAILABLE:
+    # التوقيع الصريح يجعل الترجمة تتم عند تحميل التطبيق بدلاً من أول استدعاء
+    @njit('void(float64[:], float64[:], float64[:], float64[:], float64[:], float64[:], boolean[:])',
+          cache=True, parallel=True)
+    def _payment_breakdown_kernel(amounts, company_rates, vat_rates, commissions_out, vat_out, net_out, ties_out):
+        for i in prange(amounts.shape[0]):
+            scaled = amounts[i] * company_rates[i] * 100.0
+            tie = scaled - np.floor(scaled) == 0.5
+            commission = np.rint(scaled) / 100.0
+            scaled = commission * vat_rates[i] * 100.0
+            tie = tie or scaled - np.floor(scaled) == 0.5
+            vat = np.rint(scaled) / 100.0
+            scaled = (amounts[i] - commission - vat) * 100.0
+            tie = tie or scaled - np.floor(scaled) == 0.5
+            commissions_out[i] = commission
+            vat_out[i] = vat
+            net_out[i] = np.rint(scaled) / 100.0
+            ties_out[i] = tie
+
+def calculate_payment_breakdown_batch(amounts, company_rates, vat_rates):
+    """
+    نسخة متجهة (NumPy) من calculate_payment_breakdown لحساب عدة دفعات دفعة واحدة
+    (مثل البيانات التجريبية أو إعادة احتساب العمولات عند تغيير النسب).
+    company_rates و vat_rates يمكن أن تكون قيمة واحدة أو مصفوفة بنفس طول amounts.
+    تُرجع ثلاث مصفوفات: العمولة، الضريبة على العمولة، الصافي للمالك.
+    عند توفر Numba يُستخدم kernel مترجم ومتوازٍ بدلاً من عمليات NumPy.
+    النتائج مطابقة تماماً لـ calculate_payment_breakdown: الصفوف التي تقع على منتصف
+    الهللة يُعاد حسابها بالدالة الأصلية.
+    """
+    amounts = np.ascontiguousarray(np.atleast_1d(amounts), dtype=np.float64)
+    company_rates = np.array(np.broadcast_to(np.asarray(company_rates, dtype=np.float64), amounts.shape))
+    vat_rates = np.array(np.broadcast_to(np.asarray(vat_rates, dtype=np.float64), amounts.shape))
+
+    if NUMBA_AVAILABLE and amounts.ndim == 1:
+        company_commissions = np.empty_like(amounts)
+        vat_on_commissions = np.empty_like(amounts)
+        net_to_owners = np.empty_like(amounts)
+        ties = np.empty(amounts.shape, dtype=np.bool_)
+        _payment_breakdown_kernel(amounts, company_rates, vat_rates,
+                                  company_commissions, vat_on_commissions, net_to_owners, ties)
+    else:
+        company_commissions, commission_ties = _round_cents(amounts * company_rates)
+        vat_on_commissions, vat_ties = _round_cents(company_commissions * vat_rates)
+        net_to_owners, net_ties = _round_cents(amounts - company_commissions - vat_on_commissions)
+        ties = commission_ties | vat_ties | net_ties
+
+    # float() ضروري: round على np.float64 يستخدم تقريب NumPy وليس تقريب بايثون
+    for i in np.flatnonzero(ties):
+        company_commissions.flat[i], vat_on_commissions.flat[i], net_to_owners.flat[i] = calculate_payment_breakdown(
+            float(amounts.flat[i]), float(company_rates.flat[i]), float(vat_rates.flat[i]))
+    return company_commissions, vat_on_commissions, net_to_owners
+
+# أجزاء التقرير النصي الثابتة - تُبنى مرة واحدة عند تحميل التطبيق
+REPORT_BAR = "═" * 78
+REPORT_RULE = "-" * 50
+REPORT_DOUBLE_RULE = "=" * 50
+REPORT_HEADER = "\n".join([
+    "╔" + REPORT_BAR + "╗",
+    "║                    تقرير شامل للدفعات - شركة كثيب للاستثمار                    ║",
+    "╚" + REPORT_BAR + "╝",
+    ""
+])
+REPORT_FOOTER = "\n".join([
+    "╔" + REPORT_BAR + "╗",
+    "║                              نهاية التقرير الشامل                              ║",
+    "╚" + REPORT_BAR + "╝",
+    "",
+    "📋 تم إنشاء هذا التقرير بواسطة نظام إدارة شركة كثيب للاستثمار",
+    "🏢 التقرير يعكس البيانات الحالية في قاعدة البيانات",
+    "⚡ تم تحديث التقرير في الوقت الفعلي",
+    "",
+    "📞 للاستفسارات أو الدعم الفني، يرجى التواصل مع قسم تقنية المعلومات"
+])
+MONTHLY_TABLE_HEADER = "\n".join([
+    "شهر        │ دفعات │ مالكين │ مستأجرين │ إجمالي المبالغ │ العمولات",
+    "-" * 70
+])
+MONTHLY_ROW_FMT = "{month:<10} │ {count:<6} │ {owners:<7} │ {tenants:<9} │ {total:>13,.2f} │ {commissions:>8,.2f}"
+PROJECT_BLOCK_FMT = "\n".join([
+    "📁 {name}",
+    "   🔢 عدد الدفعات: {count}",
+    "   💰 إجمالي المبالغ: {total:,.2f} ريال ({percentage:.1f}%)",
+    "   💼 إجمالي العمولات: {commissions:,.2f} ريال",
+    ""
+])
+QUARTER_BLOCK_FMT = "\n".join([
+    "🗓️  {quarter}",
+    "   🔢 عدد الدفعات: {count}",
+    "   💰 إجمالي المبالغ: {total:,.2f} ريال",
+    "   💼 إجمالي العمولات: {commissions:,.2f} ريال",
+    ""
+])
+
+def date_range_end(end_date):
+    """الحد الأعلى (الحصري) لنطاق ينتهي بيوم end_date: بداية اليوم التالي"""
+    # Payment.date < end يشمل دفعات اليوم الأخير كاملة ويبقى مقارنة مباشرة على العمود المفهرس
+    return datetime.fromisoformat(end_date) + timedelta(days=1)
+
+# التقرير الشامل يُخزن مؤقتاً حسب الفلاتر - يُفرّغ مع ذاكرة لوحة التحكم بعد اعتماد أي تغيير في البيانات
+# التفريغ يحدث في العامل الذي كتب فقط، فالمدة القصيرة (مثل لوحة التحكم) تحد من قدم التقرير في بقية العمال
+report_cache = TTLCache(maxsize=64, ttl=30)
+report_cache_lock = threading.Lock()
+
+@cached(report_cache, lock=report_cache_lock)
 def generate_comprehensive_report(start_date=None, end_date=None, project_id=None, payer_type=None):
     """توليد تقرير نصي شامل محسن للدفعات"""
-    query = Payment.query
-
-    # تطبيق الفلاتر
-    if start_date:
-        query = query.filter(Payment.date >= datetime.strptime(start_date, '%Y-%m-%d'))
-    if end_date:
-        query = query.filter(Payment.date <= datetime.strptime(end_date, '%Y-%m-%d'))
+    # تحويل التواريخ مرة واحدة (صيغة ISO القادمة من حقول التاريخ في HTML)
+    start_dt = datetime.fromisoformat(start_date) if start_date else None
+    end_dt = date_range_end(end_date) if end_date else None
+
+    # شروط الفلترة - تُطبق على جميع استعلامات التجميع
+    conditions = []
+    if start_dt:
+        conditions.append(Payment.date >= start_dt)
+    if end_dt:
+        conditions.append(Payment.date < end_dt)
     if project_id:
-        query = query.join(Unit).filter(Unit.project_id == int(project_id))
+        conditions.append(Unit.project_id == int(project_id))
     if payer_type:
-        query = query.filter(Payment.payer_type == payer_type)
+        conditions.append(Payment.payer_type == payer_type)
 
-    payments = query.order_by(Payment.date.desc()).all()
+    def payments_query(*entities):
+        """استعلام على الدفعات المفلترة - التجميع يتم داخل قاعدة البيانات"""
+        query = db.session.query(*entities).select_from(Payment)
+        if project_id:
+            query = query.join(Payment.unit)
+        return query.filter(*conditions)
+
+    # استعلام تجميع واحد حسب (المشروع، الشهر، نوع الدافع) - يُقرأ جدول الدفعات مرة واحدة
+    # ثم تُشتق جميع الإحصائيات بمرور واحد على الصفوف المجمعة (عددها صغير)
+    year_col = db.extract('year', Payment.date)
+    month_col = db.extract('month', Payment.date)
+    has_unit_col = Unit.id.isnot(None)
+    grouped_rows = db.session.query(
+        Unit.project_id,
+        has_unit_col,
+        year_col,
+        month_col,
+        Payment.payer_type,
+        db.func.count(Payment.id),
+        db.func.sum(Payment.amount),
+        db.func.sum(Payment.company_commission),
+        db.func.sum(Payment.vat_on_commission),
+        db.func.sum(Payment.net_to_owner),
+        db.func.min(Payment.date)
+    ).select_from(Payment).outerjoin(Payment.unit).filter(*conditions).group_by(
+        Unit.project_id, has_unit_col, year_col, month_col, Payment.payer_type
+    ).all()
+
+    # أسماء المشاريع تُجلب مرة واحدة لمعرفاتها الظاهرة فقط بدلاً من ربط جدول المشاريع بالتجميع
+    project_ids = {row[0] for row in grouped_rows if row[0] is not None}
+    project_names = dict(
+        db.session.query(Project.id, Project.name).filter(Project.id.in_(project_ids))
+    ) if project_ids else {}
 
     # إحصائيات أساسية محسنة
-    total_payments = sum(p.amount for p in payments) if payments else 0
-    total_commissions = sum(p.company_commission for p in payments) if payments else 0
-    total_vat = sum(p.vat_on_commission for p in payments) if payments else 0
-    net_to_owners = sum(p.net_to_owner for p in payments) if payments else 0
-
-    # إحصائيات متقدمة
-    owner_payments = [p for p in payments if p.payer_type == 'owner']
-    tenant_payments = [p for p in payments if p.payer_type == 'tenant']
-
-    # إحصائيات المشاريع
-    project_stats = {}
-    for payment in payments:
-        unit = db.session.get(Unit, payment.unit_id)
-        if unit:
-            project = db.session.get(Project, unit.project_id)
-            project_name = project.name if project else "غير محدد"
-            if project_name not in project_stats:
-                project_stats[project_name] = {'count': 0, 'total': 0, 'commissions': 0}
-            project_stats[project_name]['count'] += 1
-            project_stats[project_name]['total'] += payment.amount
-            project_stats[project_name]['commissions'] += payment.company_commission
-
-    # إحصائيات شهرية محسنة
-    monthly_stats = {}
-    quarterly_stats = {}
-    for payment in payments:
-        month_key = payment.date.strftime('%Y-%m')
-        quarter_key = f"{payment.date.year}-Q{(payment.date.month-1)//3 + 1}"
-
-        if month_key not in monthly_stats:
-            monthly_stats[month_key] = {'count': 0, 'total': 0, 'commissions': 0, 'owners': 0, 'tenants': 0}
-        if quarter_key not in quarterly_stats:
-            quarterly_stats[quarter_key] = {'count': 0, 'total': 0, 'commissions': 0}
-
-        monthly_stats[month_key]['count'] += 1
-        monthly_stats[month_key]['total'] += payment.amount
-        monthly_stats[month_key]['commissions'] += payment.company_commission
-        if payment.payer_type == 'owner':
-            monthly_stats[month_key]['owners'] += 1
+    payments_count = 0
+    total_payments = total_commissions = total_vat = net_to_owners = 0
+    first_payment_date = None
+
+    # إحصائيات متقدمة - defaultdict ينشئ المجمّع عند أول ظهور للمفتاح فقط
+    payer_stats = defaultdict(lambda: {'count': 0, 'total': 0})
+    project_stats = defaultdict(lambda: {'count': 0, 'total': 0, 'commissions': 0})
+    monthly_stats = defaultdict(lambda: {'count': 0, 'total': 0, 'commissions': 0, 'owners': 0, 'tenants': 0})
+    quarterly_stats = defaultdict(lambda: {'count': 0, 'total': 0, 'commissions': 0})
+
+    for row_project_id, has_unit, year, month, row_payer_type, count, total, commissions, vat, net, first_date in grouped_rows:
+        total = total or 0
+        commissions = commissions or 0
+        year, month = int(year), int(month)
+
+        payments_count += count
+        total_payments += total
+        total_commissions += commissions
+        total_vat += vat or 0
+        net_to_owners += net or 0
+        if first_payment_date is None or first_date < first_payment_date:
+            first_payment_date = first_date
+
+        payer = payer_stats[row_payer_type]
+        payer['count'] += count
+        payer['total'] += total
+
+        # إحصائيات المشاريع (الدفعات بدون وحدة لا تُحسب ضمن أي مشروع)
+        if has_unit:
+            project = project_stats[project_names.get(row_project_id) or "غير محدد"]
+            project['count'] += count
+            project['total'] += total
+            project['commissions'] += commissions
+
+        # إحصائيات شهرية محسنة - المفاتيح أزواج أعداد صحيحة وتُنسق كنص عند الطباعة فقط
+        month_key = (year, month)
+        quarter_key = (year, (month - 1) // 3 + 1)
+
+        monthly = monthly_stats[month_key]
+        monthly['count'] += count
+        monthly['total'] += total
+        monthly['commissions'] += commissions
+        if row_payer_type == 'owner':
+            monthly['owners'] += count
         else:
-            monthly_stats[month_key]['tenants'] += 1
+            monthly['tenants'] += count
 
-        quarterly_stats[quarter_key]['count'] += 1
-        quarterly_stats[quarter_key]['total'] += payment.amount
-        quarterly_stats[quarter_key]['commissions'] += payment.company_commission
+        quarterly = quarterly_stats[quarter_key]
+        quarterly['count'] += count
+        quarterly['total'] += total
+        quarterly['commissions'] += commissions
+
+    owner_payments = payer_stats.get('owner', {'count': 0, 'total': 0})
+    tenant_payments = payer_stats.get('tenant', {'count': 0, 'total': 0})
 
     # إحصائيات الأداء
-    avg_payment = total_payments / len(payments) if payments else 0
-    avg_commission = total_commissions / len(payments) if payments else 0
+    avg_payment = total_payments / payments_count if payments_count else 0
+    avg_commission = total_commissions / payments_count if payments_count else 0
     commission_percentage = (total_commissions / total_payments * 100) if total_payments > 0 else 0
 
-    # تحليل الاتجاهات
+    # الأشهر مرتبة مرة واحدة - تُستخدم لتحليل الاتجاه وللجدول الشهري
+    months = sorted(monthly_stats)
+
+    # تحليل الاتجاهات - إجماليات الأشهر كمصفوفة NumPy لحساب معدلات النمو دفعة واحدة
+    month_totals = np.array([monthly_stats[month]['total'] for month in months], dtype=np.float64)
+    prev_totals = month_totals[:-1]
+    growth_rates = np.divide(
+        np.diff(month_totals), prev_totals,
+        out=np.full(prev_totals.shape, np.nan), where=prev_totals > 0
+    ) * 100
+
     trend_analysis = []
-    if len(monthly_stats) > 1:
-        months = sorted(monthly_stats.keys())
-        if len(months) >= 2:
-            current_month = months[-1]
-            prev_month = months[-2]
-            current_total = monthly_stats[current_month]['total']
-            prev_total = monthly_stats[prev_month]['total']
-            if prev_total > 0:
-                growth_rate = ((current_total - prev_total) / prev_total) * 100
-                trend_analysis.append(f"معدل النمو الشهري: {growth_rate:+.2f}%")
+    monthly_growth = None
+    if growth_rates.size and not np.isnan(growth_rates[-1]):
+        monthly_growth = float(growth_rates[-1])
+        trend_analysis.append(f"معدل النمو الشهري: {monthly_growth:+.2f}%")
 
     # بناء التقرير المحسن
-    report = []
+    now = datetime.now()
+    # مخزن نصي واحد بدلاً من قائمة أسطر ثم join
+    report = io.StringIO()
+    write = report.write
+
+    def add(line):
+        write(line)
+        write("\n")
 
     # رأس التقرير
-    report.append("╔" + "═" * 78 + "╗")
-    report.append("║                    تقرير شامل للدفعات - شركة كثيب للاستثمار                    ║")
-    report.append("╚" + "═" * 78 + "╝")
-    report.append("")
-    report.append(f"📅 تاريخ إنشاء التقرير: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    report.append(f"📊 عدد السجلات المُحلّلة: {len(payments)}")
-    report.append(f"🔄 حالة التقرير: مُحدّث تلقائياً من قاعدة البيانات")
-    report.append("")
+    add(REPORT_HEADER)
+    add(f"📅 تاريخ إنشاء التقرير: {now.strftime('%Y-%m-%d %H:%M:%S')}")
+    add(f"📊 عدد السجلات المُحلّلة: {payments_count}")
+    add(f"🔄 حالة التقرير: مُحدّث تلقائياً من قاعدة البيانات")
+    add("")
 
     # فلاتر المستخدمة
     if start_date or end_date or project_id or payer_type:
-        report.append("🔍 الفلاتر المطبقة:")
-        report.append("-" * 50)
+        add("🔍 الفلاتر المطبقة:")
+        add(REPORT_RULE)
         if start_date:
-            report.append(f"  📅 من تاريخ: {start_date}")
+            add(f"  📅 من تاريخ: {start_date}")
         if end_date:
-            report.append(f"  📅 إلى تاريخ: {end_date}")
+            add(f"  📅 إلى تاريخ: {end_date}")
         if project_id:
             project = db.session.get(Project, int(project_id))
             if project:
-                report.append(f"  🏗️  المشروع: {project.name}")
+                add(f"  🏗️  المشروع: {project.name}")
         if payer_type:
             type_name = "👤 مالك" if payer_type == 'owner' else "🏢 مستأجر"
-            report.append(f"  {type_name}")
-        report.append("")
+            add(f"  {type_name}")
+        add("")
 
     # الملخص التنفيذي
-    report.append("📈 الملخص التنفيذي:")
-    report.append("=" * 50)
-    report.append(f"💰 إجمالي المبالغ المدفوعة: {total_payments:,.2f} ريال")
-    report.append(f"💼 إجمالي العمولات: {total_commissions:,.2f} ريال ({commission_percentage:.1f}%)")
-    report.append(f"🧾 إجمالي ضريبة القيمة المضافة: {total_vat:,.2f} ريال")
-    report.append(f"✅ صافي المبالغ للمالكين: {net_to_owners:,.2f} ريال")
-    report.append("")
-    report.append(f"📊 متوسط المبلغ لكل دفعة: {avg_payment:,.2f} ريال")
-    report.append(f"📈 متوسط العمولة لكل دفعة: {avg_commission:,.2f} ريال")
+    add("📈 الملخص التنفيذي:")
+    add(REPORT_DOUBLE_RULE)
+    add(f"💰 إجمالي المبالغ المدفوعة: {total_payments:,.2f} ريال")
+    add(f"💼 إجمالي العمولات: {total_commissions:,.2f} ريال ({commission_percentage:.1f}%)")
+    add(f"🧾 إجمالي ضريبة القيمة المضافة: {total_vat:,.2f} ريال")
+    add(f"✅ صافي المبالغ للمالكين: {net_to_owners:,.2f} ريال")
+    add("")
+    add(f"📊 متوسط المبلغ لكل دفعة: {avg_payment:,.2f} ريال")
+    add(f"📈 متوسط العمولة لكل دفعة: {avg_commission:,.2f} ريال")
     if trend_analysis:
-        report.append(f"📉 {trend_analysis[0]}")
-    report.append("")
+        add(f"📉 {trend_analysis[0]}")
+    add("")
 
     # إحصائيات مفصلة حسب النوع
-    report.append("👥 تحليل حسب نوع الدافع:")
-    report.append("-" * 50)
+    add("👥 تحليل حسب نوع الدافع:")
+    add(REPORT_RULE)
 
-    owner_count = len(owner_payments)
-    tenant_count = len(tenant_payments)
-    owner_percentage = (owner_count / len(payments) * 100) if payments else 0
-    tenant_percentage = (tenant_count / len(payments) * 100) if payments else 0
+    owner_count = owner_payments['count']
+    tenant_count = tenant_payments['count']
+    owner_percentage = (owner_count / payments_count * 100) if payments_count else 0
+    tenant_percentage = (tenant_count / payments_count * 100) if payments_count else 0
 
-    report.append(f"👤 دفعات المالكين: {owner_count} دفعة ({owner_percentage:.1f}%)")
-    if owner_payments:
-        owner_total = sum(p.amount for p in owner_payments)
+    add(f"👤 دفعات المالكين: {owner_count} دفعة ({owner_percentage:.1f}%)")
+    if owner_count:
+        owner_total = owner_payments['total']
         owner_avg = owner_total / owner_count
-        report.append(f"   💰 إجمالي: {owner_total:,.2f} ريال")
-        report.append(f"   📊 متوسط: {owner_avg:,.2f} ريال")
+        add(f"   💰 إجمالي: {owner_total:,.2f} ريال")
+        add(f"   📊 متوسط: {owner_avg:,.2f} ريال")
 
-    report.append(f"🏢 دفعات المستأجرين: {tenant_count} دفعة ({tenant_percentage:.1f}%)")
-    if tenant_payments:
-        tenant_total = sum(p.amount for p in tenant_payments)
+    add(f"🏢 دفعات المستأجرين: {tenant_count} دفعة ({tenant_percentage:.1f}%)")
+    if tenant_count:
+        tenant_total = tenant_payments['total']
         tenant_avg = tenant_total / tenant_count
-        report.append(f"   💰 إجمالي: {tenant_total:,.2f} ريال")
-        report.append(f"   📊 متوسط: {tenant_avg:,.2f} ريال")
-    report.append("")
+        add(f"   💰 إجمالي: {tenant_total:,.2f} ريال")
+        add(f"   📊 متوسط: {tenant_avg:,.2f} ريال")
+    add("")
 
     # إحصائيات المشاريع
     if project_stats:
-        report.append("🏗️  تحليل حسب المشاريع:")
-        report.append("-" * 50)
+        add("🏗️  تحليل حسب المشاريع:")
+        add(REPORT_RULE)
         for project_name, stats in sorted(project_stats.items(), key=lambda x: x[1]['total'], reverse=True):
             percentage = (stats['total'] / total_payments * 100) if total_payments > 0 else 0
-            report.append(f"📁 {project_name}")
-            report.append(f"   🔢 عدد الدفعات: {stats['count']}")
-            report.append(f"   💰 إجمالي المبالغ: {stats['total']:,.2f} ريال ({percentage:.1f}%)")
-            report.append(f"   💼 إجمالي العمولات: {stats['commissions']:,.2f} ريال")
-            report.append("")
-        report.append("")
+            add(PROJECT_BLOCK_FMT.format(name=project_name, percentage=percentage, **stats))
+        add("")
 
     # التحليل الشهري
     if monthly_stats:
-        report.append("📅 التحليل الشهري:")
-        report.append("-" * 50)
-        report.append("شهر        │ دفعات │ مالكين │ مستأجرين │ إجمالي المبالغ │ العمولات")
-        report.append("-" * 70)
-        for month in sorted(monthly_stats.keys(), reverse=True)[:6]:  # آخر 6 أشهر
+        add("📅 التحليل الشهري:")
+        add(REPORT_RULE)
+        add(MONTHLY_TABLE_HEADER)
+        for month in reversed(months[-6:]):  # آخر 6 أشهر
             stats = monthly_stats[month]
-            report.append(f"{month:<10} │ {stats['count']:<6} │ {stats['owners']:<7} │ {stats['tenants']:<9} │ {stats['total']:>13,.2f} │ {stats['commissions']:>8,.2f}")
-        report.append("")
+            add(MONTHLY_ROW_FMT.format(month=f"{month[0]}-{month[1]:02d}", **stats))
+        add("")
 
     # التحليل الربع سنوي
     if quarterly_stats:
-        report.append("📊 التحليل الربع سنوي:")
-        report.append("-" * 50)
+        add("📊 التحليل الربع سنوي:")
+        add(REPORT_RULE)
         for quarter in sorted(quarterly_stats.keys(), reverse=True):
             stats = quarterly_stats[quarter]
-            report.append(f"🗓️  {quarter}")
-            report.append(f"   🔢 عدد الدفعات: {stats['count']}")
-            report.append(f"   💰 إجمالي المبالغ: {stats['total']:,.2f} ريال")
-            report.append(f"   💼 إجمالي العمولات: {stats['commissions']:,.2f} ريال")
-            report.append("")
+            add(QUARTER_BLOCK_FMT.format(quarter=f"{quarter[0]}-Q{quarter[1]}", **stats))
 
     # مؤشرات الأداء الرئيسية
-    report.append("🎯 مؤشرات الأداء الرئيسية (KPIs):")
-    report.append("-" * 50)
-    report.append(f"📈 معدل العمولة: {commission_percentage:.2f}%")
-    report.append(f"💰 متوسط حجم الصفقة: {avg_payment:,.2f} ريال")
-    report.append(f"⚡ عدد الصفقات يومياً: {len(payments) / max(1, (datetime.now().date() - payments[-1].date.date()).days + 1) if payments else 0:.1f}")
-    report.append(f"🎪 تنوع المشاريع: {len(project_stats)} مشروع")
-    report.append("")
+    projects_count = len(project_stats)
+    if payments_count:
+        span_days = max(1, (now.date() - first_payment_date.date()).days + 1)
+        payments_per_day = payments_count / span_days
+    else:
+        payments_per_day = 0
+    add("🎯 مؤشرات الأداء الرئيسية (KPIs):")
+    add(REPORT_RULE)
+    add(f"📈 معدل العمولة: {commission_percentage:.2f}%")
+    add(f"💰 متوسط حجم الصفقة: {avg_payment:,.2f} ريال")
+    add(f"⚡ عدد الصفقات يومياً: {payments_per_day:.1f}")
+    add(f"🎪 تنوع المشاريع: {projects_count} مشروع")
+    add("")
 
     # أكبر الصفقات
-    if payments:
-        top_payments = sorted(payments, key=lambda x: x.amount, reverse=True)[:5]
-        report.append("🏆 أكبر الصفقات:")
-        report.append("-" * 50)
+    if payments_count:
+        # الأعمدة المعروضة فقط بدلاً من كائنات Payment الكاملة
+        top_payments = payments_query(
+            Payment.amount, Payment.date, Payment.payer_type, Payment.description
+        ).order_by(Payment.amount.desc(), Payment.date.desc()).limit(5).all()
+        add("🏆 أكبر الصفقات:")
+        add(REPORT_RULE)
         for i, payment in enumerate(top_payments, 1):
-            report.append(f"{i}. 💰 {payment.amount:,.2f} ريال")
-            report.append(f"   📅 {payment.date.strftime('%Y-%m-%d')}")
-            report.append(f"   {'👤 مالك' if payment.payer_type == 'owner' else '🏢 مستأجر'}")
+            add(f"{i}. 💰 {payment.amount:,.2f} ريال")
+            add(f"   📅 {payment.date.strftime('%Y-%m-%d')}")
+            add(f"   {'👤 مالك' if payment.payer_type == 'owner' else '🏢 مستأجر'}")
             if payment.description:
-                report.append(f"   📝 {payment.description}")
-            report.append("")
+                add(f"   📝 {payment.description}")
+            add("")
 
     # التوصيات
-    report.append("💡 توصيات وتحليل:")
-    report.append("-" * 50)
+    add("💡 توصيات وتحليل:")
+    add(REPORT_RULE)
     if commission_percentage > 10:
-        report.append("⚠️  معدل العمولة مرتفع نسبياً، قد يحتاج إلى مراجعة")
+        add("⚠️  معدل العمولة مرتفع نسبياً، قد يحتاج إلى مراجعة")
     elif commission_percentage < 3:
-        report.append("⚠️  معدل العمولة منخفض، تأكد من الربحية")
+        add("⚠️  معدل العمولة منخفض، تأكد من الربحية")
 
-    if len(project_stats) > 5:
-        report.append("📊 تنوع جيد في المشاريع، مما يقلل من المخاطر")
-    elif len(project_stats) <= 2:
-        report.append("⚠️  تركيز على عدد محدود من المشاريع، قد يزيد من المخاطر")
+    if projects_count > 5:
+        add("📊 تنوع جيد في المشاريع، مما يقلل من المخاطر")
+    elif projects_count <= 2:
+        add("⚠️  تركيز على عدد محدود من المشاريع، قد يزيد من المخاطر")
 
-    if trend_analysis and trend_analysis[0].startswith("معدل النمو"):
-        growth = float(trend_analysis[0].split(": ")[1].rstrip("%"))
-        if growth > 10:
-            report.append("🚀 نمو ممتاز في الإيرادات")
-        elif growth < -5:
-            report.append("⚠️  انخفاض في الإيرادات، يحتاج إلى تحليل")
-    report.append("")
+    if monthly_growth is not None:
+        if monthly_growth > 10:
+            add("🚀 نمو ممتاز في الإيرادات")
+        elif monthly_growth < -5:
+            add("⚠️  انخفاض في الإيرادات، يحتاج إلى تحليل")
+    add("")
 
     # خاتمة التقرير
-    report.append("╔" + "═" * 78 + "╗")
-    report.append("║                              نهاية التقرير الشامل                              ║")
-    report.append("╚" + "═" * 78 + "╝")
-    report.append("")
-    report.append("📋 تم إنشاء هذا التقرير بواسطة نظام إدارة شركة كثيب للاستثمار")
-    report.append("🏢 التقرير يعكس البيانات الحالية في قاعدة البيانات")
-    report.append("⚡ تم تحديث التقرير في الوقت الفعلي")
-    report.append("")
-    report.append("📞 للاستفسارات أو الدعم الفني، يرجى التواصل مع قسم تقنية المعلومات")
-    report.append(f"⏰ وقت إنشاء التقرير: {datetime.now().strftime('%H:%M:%S')}")
-
-    return "\n".join(report)
+    add(REPORT_FOOTER)
+    add(f"⏰ وقت إنشاء التقرير: {now.strftime('%H:%M:%S')}")
+
+    # إزالة فاصل السطر الأخير ليطابق الناتج السابق
+    return report.getvalue()[:-1]
+
+# مؤشرات لوحة التحكم تتغير فقط عند الكتابة، لذا نحفظها مؤقتاً لمدة قصيرة
+# ونفرغ الذاكرة المؤقتة بعد اعتماد (commit) أي إضافة/تعديل/حذف على الجداول المعنية
+DashboardKPIs = namedtuple('DashboardKPIs', [
+    'total_payments', 'total_commissions', 'total_vat', 'net_paid_to_owners',
+    'total_owners', 'total_tenants', 'total_projects', 'total_units',
+    'available_units', 'rented_units'
+])
+dashboard_cache = TTLCache(maxsize=16, ttl=30)
+dashboard_cache_lock = threading.Lock()
+
+@cached(dashboard_cache, lock=dashboard_cache_lock)
+def compute_dashboard_kpis():
+    """حساب مؤشرات لوحة التحكم (المبالغ الإجمالية وأعداد السجلات)"""
+    totals = db.session.query(
+        db.func.sum(Payment.amount),
+        db.func.sum(Payment.company_commission),
+        db.func.sum(Payment.vat_on_commission),
+        db.func.sum(Payment.net_to_owner)
+    ).one()
+    total_payments, total_commissions, total_vat, net_paid_to_owners = (value or 0 for value in totals)
+
+    # جميع الأعداد في استعلام واحد: جدول الوحدات يُقرأ مرة واحدة وأعداد الجداول الأخرى كاستعلامات فرعية
+    total_owners, total_tenants, total_projects, total_units, available_units, rented_units = db.session.query(
+        db.session.query(db.func.count(Owner.id)).scalar_subquery(),
+        db.session.query(db.func.count(Tenant.id)).scalar_subquery(),
+        db.session.query(db.func.count(Project.id)).scalar_subquery(),
+        db.func.count(Unit.id),
+        db.func.count(db.case((Unit.status == 'available', 1))),
+        db.func.count(db.case((Unit.status == 'rented', 1)))
+    ).select_from(Unit).one()
+
+    return DashboardKPIs(
+        total_payments=total_payments,
+        total_commissions=total_commissions,
+        total_vat=total_vat,
+        net_paid_to_owners=net_paid_to_owners,
+        total_owners=total_owners,
+        total_tenants=total_tenants,
+        total_projects=total_projects,
+        total_units=total_units,
+        available_units=available_units,
+        rented_units=rented_units
+    )
+
+# قوائم الاختيار (المعرف والاسم) في نماذج التعديل - تُفرغ مع مؤشرات لوحة التحكم عند أي تغيير
+choices_cache = TTLCache(maxsize=8, ttl=60)
+choices_cache_lock = threading.Lock()
+
+@cached(choices_cache, key=lambda: 'owners', lock=choices_cache_lock)
+def owner_choices():
+    """الملاك لقوائم الاختيار"""
+    return Owner.query.with_entities(Owner.id, Owner.name, Owner.national_id, Owner.sab_number).order_by(Owner.id).all()
+
+@cached(choices_cache, key=lambda: 'tenants', lock=choices_cache_lock)
+def tenant_choices():
+    """المستأجرون لقوائم الاختيار"""
+    return Tenant.query.with_entities(Tenant.id, Tenant.name).order_by(Tenant.id).all()
+
+@cached(choices_cache, key=lambda: 'projects', lock=choices_cache_lock)
+def project_choices():
+    """المشاريع لقوائم الاختيار"""
+    return Project.query.with_entities(Project.id, Project.name).order_by(Project.id).all()
+
+@cached(choices_cache, key=lambda: 'units', lock=choices_cache_lock)
+def unit_choices():
+    """الوحدات مع اسم مشروعها لقوائم الاختيار"""
+    return db.session.query(Unit.id, Unit.unit_number, Project.name.label('project_name')).outerjoin(
+        Unit.project
+    ).order_by(Unit.id).all()
+
+def clear_dashboard_cache(*args):
+    """تفريغ الذاكرة المؤقتة لمؤشرات لوحة التحكم والتقارير وقوائم الاختيار بعد أي تغيير في البيانات"""
+    with dashboard_cache_lock:
+        dashboard_cache.clear()
+    with choices_cache_lock:
+        choices_cache.clear()
+    with report_cache_lock:
+        report_cache.clear()
+
+def mark_caches_stale(mapper, connection, target):
+    """تُستدعى عند الـ flush: التفريغ الفعلي ينتظر نجاح الـ commit حتى لا تُملأ الذاكرة ببيانات لم تُعتمد"""
+    session = object_session(target)
+    if session is not None:
+        session.info['caches_stale'] = True
+
+for model in (Payment, Owner, Tenant, Project, Unit):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, event_name, mark_caches_stale)
+
+@event.listens_for(db.session, 'after_commit')
+def clear_caches_after_commit(session):
+    if session.info.pop('caches_stale', False):
+        clear_dashboard_cache()
+        try:
+            bump_export_data_version()
+        except OSError:
+            app.logger.exception("تعذر تحديث إصدار بيانات التصدير")
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_stale_caches_mark(session):
+    # التغييرات أُلغيت فالذاكرة المؤقتة ما زالت صحيحة
+    session.info.pop('caches_stale', None)
 
 def seed_sample_data():
     """ملئ بيانات تجريبية إذا كانت الجداول فارغة"""
+    # bulk_insert_mappings يدرج القواميس مباشرة دون إنشاء كائنات ORM وتتبع حالتها
     # SQLite seeding
-    if Owner.query.count() == 0:
+    if db.session.query(Owner.id).first() is None:
         owners = [
-            Owner(name="محمود العسيري", national_id="1010101010", phone="0500000001", email="ma@kthaib.com", address="الرياض", sab_number="ساب-001"),
-            Owner(name="نورة الشمري", national_id="2020202020", phone="0500000002", email="ns@kthaib.com", address="جدة", sab_number="ساب-002"),
-            Owner(name="أحمد الخالدي", national_id="3030303030", phone="0500000003", email="ah@kthaib.com", address="الدمام", sab_number="ساب-003"),
-            Owner(name="فاطمة الزهراء", national_id="4040404040", phone="0500000004", email="fz@kthaib.com", address="مكة", sab_number="ساب-004"),
-            Owner(name="سعد المنصور", national_id="5050505050", phone="0500000005", email="sm@kthaib.com", address="المدينة", sab_number="ساب-005")
+            dict(name="محمود العسيري", national_id="1010101010", phone="0500000001", email="ma@kthaib.com", address="الرياض", sab_number="ساب-001"),
+            dict(name="نورة الشمري", national_id="2020202020", phone="0500000002", email="ns@kthaib.com", address="جدة", sab_number="ساب-002"),
+            dict(name="أحمد الخالدي", national_id="3030303030", phone="0500000003", email="ah@kthaib.com", address="الدمام", sab_number="ساب-003"),
+            dict(name="فاطمة الزهراء", national_id="4040404040", phone="0500000004", email="fz@kthaib.com", address="مكة", sab_number="ساب-004"),
+            dict(name="سعد المنصور", national_id="5050505050", phone="0500000005", email="sm@kthaib.com", address="المدينة", sab_number="ساب-005")
         ]
-        db.session.add_all(owners)
-    if Tenant.query.count() == 0:
+        db.session.bulk_insert_mappings(Owner, owners)
+    if db.session.query(Tenant.id).first() is None:
         tenants = [
-            Tenant(name="شركة الريادة", phone="0590000001", contract_start=datetime(2024,1,1), contract_end=datetime(2026,1,1), sab_number="ساب-ت-001", owner_id=1),
-            Tenant(name="مؤسسة النور", phone="0590000002", contract_start=datetime(2024,3,1), contract_end=datetime(2025,3,1), sab_number="ساب-ت-002", owner_id=2),
-            Tenant(name="شركة الأمل", phone="0590000003", contract_start=datetime(2024,6,1), contract_end=datetime(2027,6,1), sab_number="ساب-ت-003", owner_id=3)
+            dict(name="شركة الريادة", phone="0590000001", contract_start=datetime(2024,1,1), contract_end=datetime(2026,1,1), sab_number="ساب-ت-001", owner_id=1),
+            dict(name="مؤسسة النور", phone="0590000002", contract_start=datetime(2024,3,1), contract_end=datetime(2025,3,1), sab_number="ساب-ت-002", owner_id=2),
+            dict(name="شركة الأمل", phone="0590000003", contract_start=datetime(2024,6,1), contract_end=datetime(2027,6,1), sab_number="ساب-ت-003", owner_id=3)
         ]
-        db.session.add_all(tenants)
-    if Project.query.count() == 0:
+        db.session.bulk_insert_mappings(Tenant, tenants)
+    if db.session.query(Project.id).first() is None:
         projects = [
-            Project(name="مشروع الريان", location="الرياض", description="مشروع سكني راقٍ"),
-            Project(name="مجمع النخيل", location="جدة", description="مجمع تجاري وسكني"),
-            Project(name="برج الشروق", location="الدمام", description="برج سكني فاخر")
+            dict(name="مشروع الريان", location="الرياض", description="مشروع سكني راقٍ"),
+            dict(name="مجمع النخيل", location="جدة", description="مجمع تجاري وسكني"),
+            dict(name="برج الشروق", location="الدمام", description="برج سكني فاخر")
         ]
-        db.session.add_all(projects)
-        db.session.flush()
+        db.session.bulk_insert_mappings(Project, projects)
         units = [
-            Unit(project_id=1, unit_number="A-101", type="شقة", area=120, owner_id=1, tenant_id=1, status="rented"),
-            Unit(project_id=1, unit_number="A-102", type="شقة", area=100, owner_id=2, status="available"),
-            Unit(project_id=1, unit_number="A-103", type="شقة", area=150, owner_id=3, status="sold"),
-            Unit(project_id=2, unit_number="B-201", type="مكتب", area=80, owner_id=4, tenant_id=2, status="rented"),
-            Unit(project_id=2, unit_number="B-202", type="مكتب", area=90, owner_id=5, status="available"),
-            Unit(project_id=3, unit_number="C-301", type="شقة", area=200, owner_id=1, tenant_id=3, status="rented")
+            dict(project_id=1, unit_number="A-101", type="شقة", area=120, owner_id=1, tenant_id=1, status="rented"),
+            dict(project_id=1, unit_number="A-102", type="شقة", area=100, owner_id=2, status="available"),
+            dict(project_id=1, unit_number="A-103", type="شقة", area=150, owner_id=3, status="sold"),
+            dict(project_id=2, unit_number="B-201", type="مكتب", area=80, owner_id=4, tenant_id=2, status="rented"),
+            dict(project_id=2, unit_number="B-202", type="مكتب", area=90, owner_id=5, status="available"),
+            dict(project_id=3, unit_number="C-301", type="شقة", area=200, owner_id=1, tenant_id=3, status="rented")
         ]
-        db.session.add_all(units)
-    if Payment.query.count() == 0:
-        payments = []
-        for i in range(1, 7):
-            company_rate = 0.05
-            vat_rate = 0.15
-            amt = 4000 + i * 500  # Vary amounts
-            comm, vat, net = calculate_payment_breakdown(amt, company_rate, vat_rate)
-            pay = Payment(
+        db.session.bulk_insert_mappings(Unit, units)
+    if db.session.query(Payment.id).first() is None:
+        company_rate = 0.05
+        vat_rate = 0.15
+        indexes = range(1, 7)
+        amounts = np.array([4000 + i * 500 for i in indexes], dtype=np.float64)  # Vary amounts
+        comms, vats, nets = calculate_payment_breakdown_batch(amounts, company_rate, vat_rate)
+        payments = [
+            dict(
                 unit_id=i if i <= 6 else 1,
                 payer_type='tenant' if i % 2 == 1 else 'owner',
                 payer_id=1,
@@ -620,11 +1239,12 @@ def seed_sample_data():
                 vat_on_commission=vat,
                 net_to_owner=net
             )
-            payments.append(pay)
-        db.session.add_all(payments)
+            for i, amt, comm, vat, net in zip(indexes, amounts.tolist(), comms.tolist(), vats.tolist(), nets.tolist())
+        ]
+        db.session.bulk_insert_mappings(Payment, payments)
 
     # Seed users
-    if User.query.count() == 0:
+    if db.session.query(User.id).first() is None:
         users = [
             User(username='admin', name='مدير النظام', email='admin@kthaib.com', role='Admin'),
             User(username='accountant', name='المحاسب', email='acc@kthaib.com', role='Accountant'),
@@ -635,12 +1255,12 @@ def seed_sample_data():
             # Use stronger default passwords
             default_password = f"{user.username}Admin123!"  # e.g., adminAdmin123!
             user.set_password(default_password)
-        db.session.add_all(users)
+        db.session.bulk_save_objects(users)
 
     db.session.commit()
 
     # MongoDB seeding
-    if mongo_db is not None:
+    if mongo_db is not None and mongo_ready.wait(MONGO_SEED_WAIT):
         try:
             if owners_collection.count_documents({}) == 0:
                 mongo_owners = [
@@ -650,7 +1270,7 @@ def seed_sample_data():
                     {"name": "فاطمة الزهراء", "national_id": "4040404040", "phone": "0500000004", "email": "fz@kthaib.com", "address": "مكة", "sab_number": "ساب-004"},
                     {"name": "سعد المنصور", "national_id": "5050505050", "phone": "0500000005", "email": "sm@kthaib.com", "address": "المدينة", "sab_number": "ساب-005"}
                 ]
-                owners_collection.insert_many(mongo_owners)
+                owners_collection.insert_many(mongo_owners, ordered=False)
                 print("MongoDB seeded successfully")
         except Exception as e:
             print(f"MongoDB seeding failed: {e}")
@@ -664,14 +1284,28 @@ def seed_sample_data():
 def home():
     return render_template('homepage.html')
 
-@app.route('/health')
-def health_check():
-    """Health check endpoint for Railway monitoring"""
-    return {
-        'status': 'healthy',
-        'timestamp': datetime.utcnow().isoformat(),
-        'version': '1.0.0'
-    }
+class HealthCheckMiddleware:
+    """Answer /health at the WSGI layer for Railway monitoring
+
+    Health probes skip Flask's request setup entirely: no session, login,
+    rate-limit or HTTPS-redirect hooks run for them.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != '/health':
+            return self.wsgi_app(environ, start_response)
+        body = json.dumps({
+            'status': 'healthy',
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'version': '1.0.0'
+        }).encode()
+        start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+
+app.wsgi_app = HealthCheckMiddleware(app.wsgi_app)
 
 @app.route('/login', methods=['GET','POST'])
 @limiter.limit("5 per minute")
@@ -699,8 +1333,9 @@ def login():
             flash('اسم المستخدم غير موجود.', 'danger')
             return render_template('login.html')
 
-        if user.is_account_locked():
-            remaining_time = int((user.locked_until - datetime.utcnow()).total_seconds() / 60)
+        remaining_lock = user.lock_remaining()
+        if remaining_lock:
+            remaining_time = int(remaining_lock.total_seconds() / 60)
             flash(f'الحساب مقفل مؤقتاً. يرجى المحاولة مرة أخرى بعد {remaining_time} دقيقة.', 'warning')
             return render_template('login.html')
 
@@ -711,28 +1346,28 @@ def login():
         if user.check_password(password):
             # Successful login
             user.reset_login_attempts()
+            db.session.commit()
             login_user(user, remember=remember, duration=timedelta(days=30) if remember else None)
 
             # Log successful login with IP
             user_ip = request.remote_addr
-            db.session.add(AuditLog(action=f"تسجيل دخول ناجح للمستخدم {username} من IP: {user_ip}", user=username))
-            db.session.commit()
+            queue_audit(f"تسجيل دخول ناجح للمستخدم {username} من IP: {user_ip}", username)
 
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('dashboard'))
         else:
             # Failed login attempt
-            user.increment_login_attempts()
+            attempts = user.increment_login_attempts()
+            db.session.commit()
 
             # Log failed login attempt with IP
             user_ip = request.remote_addr
-            db.session.add(AuditLog(action=f"محاولة تسجيل دخول فاشلة للمستخدم {username} من IP: {user_ip}", user=username))
-            db.session.commit()
+            queue_audit(f"محاولة تسجيل دخول فاشلة للمستخدم {username} من IP: {user_ip}", username)
 
-            if user.login_attempts >= 5:
+            if attempts >= LOGIN_MAX_ATTEMPTS:
                 flash('تم قفل الحساب بسبب محاولات تسجيل الدخول المتكررة. يرجى المحاولة مرة أخرى بعد 30 دقيقة.', 'danger')
             else:
-                remaining_attempts = 5 - user.login_attempts
+                remaining_attempts = LOGIN_MAX_ATTEMPTS - attempts
                 flash(f'كلمة المرور غير صحيحة. لديك {remaining_attempts} محاولات متبقية.', 'danger')
 
     return render_template('login.html')
@@ -771,7 +1406,8 @@ def reset_password(token):
 
     user = User.query.filter_by(password_reset_token=token).first()
 
-    if not user or (user.password_reset_expires and datetime.utcnow() > user.password_reset_expires):
+    if not user or (user.password_reset_expires and
+                    datetime.now(timezone.utc) > user.password_reset_expires.replace(tzinfo=timezone.utc)):
         flash('رابط إعادة تعيين كلمة المرور غير صالح أو منتهي الصلاحية.', 'danger')
         return redirect(url_for('login'))
 
@@ -787,7 +1423,6 @@ def reset_password(token):
             user.set_password(password)
             user.password_reset_token = None
             user.password_reset_expires = None
-            db.session.commit()
 
             # Log password reset
             db.session.add(AuditLog(action=f"إعادة تعيين كلمة المرور للمستخدم {user.username}", user=user.username))
@@ -801,54 +1436,35 @@ def reset_password(token):
 
     return render_template('reset_password.html', token=token)
 
+DASHBOARD_LIST_SIZE = 5
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # مؤشرات سريعة (KPIs)
-    total_payments = db.session.query(db.func.sum(Payment.amount)).scalar() or 0
-    total_commissions = db.session.query(db.func.sum(Payment.company_commission)).scalar() or 0
-    total_vat = db.session.query(db.func.sum(Payment.vat_on_commission)).scalar() or 0
-    net_paid_to_owners = db.session.query(db.func.sum(Payment.net_to_owner)).scalar() or 0
-
-    # إحصائيات إضافية
-    total_owners = Owner.query.count()
-    total_tenants = Tenant.query.count()
-    total_projects = Project.query.count()
-    total_units = Unit.query.count()
-    available_units = Unit.query.filter_by(status='available').count()
-    rented_units = Unit.query.filter_by(status='rented').count()
+    # مؤشرات سريعة (KPIs) - محفوظة مؤقتاً
+    kpis = compute_dashboard_kpis()
 
     # بيانات لعرض الجداول
     recent_payments = Payment.query.order_by(Payment.date.desc()).limit(10).all()
     recent_audit_logs = AuditLog.query.order_by(AuditLog.timestamp.desc()).limit(10).all()
-    projects = Project.query.all()
-    owners = Owner.query.all()
-    tenants = Tenant.query.all()
-
-    user_role = current_user.role if current_user.is_authenticated else None
+    # القوائم المختصرة تعرض أول 5 سجلات فقط - لا حاجة لتحميل الجداول كاملة
+    projects = Project.query.with_entities(Project.name, Project.location).order_by(Project.id).limit(DASHBOARD_LIST_SIZE).all()
+    owners = Owner.query.with_entities(Owner.name, Owner.sab_number).order_by(Owner.id).limit(DASHBOARD_LIST_SIZE).all()
+    tenants = Tenant.query.with_entities(Tenant.name, Tenant.sab_number).order_by(Tenant.id).limit(DASHBOARD_LIST_SIZE).all()
 
     return render_template('dashboard.html',
-                           total_payments=total_payments,
-                           total_commissions=total_commissions,
-                           total_vat=total_vat,
-                           net_paid_to_owners=net_paid_to_owners,
-                           total_owners=total_owners,
-                           total_tenants=total_tenants,
-                           total_projects=total_projects,
-                           total_units=total_units,
-                           available_units=available_units,
-                           rented_units=rented_units,
+                           **kpis._asdict(),
                            recent_payments=recent_payments,
                            recent_audit_logs=recent_audit_logs,
                            projects=projects, owners=owners, tenants=tenants,
-                           user_role=user_role,
+                           user_role=g.user_role,
                            active_page='dashboard')
 
 # إدارة المستخدمين
 @app.route('/users', methods=['GET', 'POST'])
 @login_required
 def users_view():
-    if current_user.role != 'Admin':
+    if g.user_role != 'Admin':
         flash('ليس لديك صلاحية للوصول إلى هذه الصفحة.', 'danger')
         return redirect(url_for('dashboard'))
 
@@ -873,10 +1489,9 @@ def users_view():
             user = User(username=username, name=name, email=email, role=role)
             user.set_password(password)
             db.session.add(user)
-            db.session.commit()
 
             # Log user creation
-            db.session.add(AuditLog(action=f"إنشاء مستخدم جديد: {username}", user=current_user.username if current_user.is_authenticated else 'system'))
+            db.session.add(AuditLog(action=f"إنشاء مستخدم جديد: {username}", user=g.username or 'system'))
             db.session.commit()
 
             flash('تم إضافة المستخدم بنجاح.', 'success')
@@ -886,10 +1501,7 @@ def users_view():
             return redirect(url_for('users_view'))
 
     users = User.query.all()
-    user_role = current_user.role if current_user.is_authenticated else None
-    current_user_name = current_user.name if current_user.is_authenticated else None
-    current_username = current_user.username if current_user.is_authenticated else None
-    return render_template('users.html', users=users, user_role=user_role, current_user_name=current_user_name, current_username=current_username, active_page='users')
+    return render_template('users.html', users=users, user_role=g.user_role, current_user_name=g.user_name, current_username=g.username, active_page='users')
 
 # إدارة الملاك
 @app.route('/owners', methods=['GET','POST'])
@@ -938,8 +1550,7 @@ def owners_view():
             sab_number=sab_number
         )
         db.session.add(o)
-        db.session.commit()
-        db.session.add(AuditLog(action=f"إنشاء مالك {o.name}", user=current_user.username if current_user.is_authenticated else 'system'))
+        db.session.add(AuditLog(action=f"إنشاء مالك {o.name}", user=g.username or 'system'))
         db.session.commit()
         flash('تم إضافة المالك بنجاح.', 'success')
         return redirect(url_for('owners_view'))
@@ -948,6 +1559,10 @@ def owners_view():
     return render_template('owners.html', owners=owners, active_page='owners')
 
 # إدارة المستأجرين
+def owner_has_tenant(owner_id):
+    """هل للمالك مستأجر؟ - استعلام EXISTS بدلاً من تحميل قائمة المستأجرين"""
+    return db.session.query(Tenant.query.filter_by(owner_id=owner_id).exists()).scalar()
+
 @app.route('/tenants', methods=['GET','POST'])
 def tenants_view():
     if request.method == 'POST':
@@ -961,7 +1576,7 @@ def tenants_view():
             flash('المالك غير موجود.', 'error')
             return redirect(url_for('tenants_view'))
 
-        if owner.tenants:
+        if owner_has_tenant(owner.id):
             flash('لا يمكن إضافة مستأجر جديد لهذا المالك لأنه يمتلك مستأجر بالفعل. يجب حذف المستأجر الحالي أولاً.', 'error')
             return redirect(url_for('tenants_view'))
 
@@ -980,33 +1595,18 @@ def tenants_view():
                     flash('نوع الملف غير مسموح به. يرجى رفع ملف PDF أو DOC أو صورة فقط.', 'danger')
                     return redirect(url_for('tenants_view'))
 
-                # Check file size (additional check beyond MAX_CONTENT_LENGTH)
-                file.seek(0, os.SEEK_END)
-                file_size = file.tell()
-                file.seek(0)
-                if file_size > 10 * 1024 * 1024:  # 10MB limit for contracts
-                    flash('حجم الملف كبير جداً. الحد الأقصى 10 ميجابايت.', 'danger')
+                # The size limit (beyond MAX_CONTENT_LENGTH) is enforced while the file is written
+                try:
+                    contract_file_path = save_contract_file(file)  # Store only the filename, not the full path
+                except FormError as e:
+                    flash(str(e), 'danger')
                     return redirect(url_for('tenants_view'))
 
-                filename = secure_filename(file.filename)
-                # Add timestamp and random string to avoid filename conflicts
-                import time
-                timestamp = str(int(time.time()))
-                random_suffix = secrets.token_hex(4)
-                filename = f"{timestamp}_{random_suffix}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-                # Ensure upload directory exists
-                os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-                file.save(file_path)
-                contract_file_path = filename  # Store only the filename, not the full path
-
         t = Tenant(
             name=request.form.get('name'),
             phone=request.form.get('phone'),
-            contract_start=datetime.strptime(contract_start, '%Y-%m-%d') if contract_start else None,
-            contract_end=datetime.strptime(contract_end, '%Y-%m-%d') if contract_end else None,
+            contract_start=date.fromisoformat(contract_start) if contract_start else None,
+            contract_end=date.fromisoformat(contract_end) if contract_end else None,
             contract_number=contract_number,
             contract_file=contract_file_path,
             sab_number=sab_number,
@@ -1016,8 +1616,9 @@ def tenants_view():
         db.session.commit()
         flash('تم إضافة المستأجر.', 'success')
         return redirect(url_for('tenants_view'))
-    tenants = Tenant.query.all()
-    owners = Owner.query.all()
+    # اسم المالك يُعرض لكل مستأجر - تحميل الملاك باستعلام واحد بدلاً من استعلام لكل صف
+    tenants = Tenant.query.options(selectinload(Tenant.owner)).all()
+    owners = owner_choices()
     return render_template('tenants.html', tenants=tenants, owners=owners, active_page='tenants')
 
 @app.route('/edit_owner/<int:owner_id>', methods=['GET', 'POST'])
@@ -1034,7 +1635,6 @@ def edit_owner(owner_id):
         owner.email = request.form.get('email')
         owner.address = request.form.get('address')
         owner.sab_number = request.form.get('sab_number')
-        db.session.commit()
         db.session.add(AuditLog(action=f"تعديل مالك {owner.name}", user='system'))
         db.session.commit()
         flash('تم تحديث المالك بنجاح.', 'success')
@@ -1063,7 +1663,7 @@ def edit_tenant(tenant_id):
                 flash('المالك الجديد غير موجود.', 'error')
                 return redirect(url_for('edit_tenant', tenant_id=tenant_id))
 
-            if new_owner.tenants:
+            if owner_has_tenant(new_owner_id):
                 flash('لا يمكن نقل المستأجر إلى هذا المالك لأنه يمتلك مستأجر بالفعل. يجب حذف المستأجر الحالي للمالك الجديد أولاً.', 'error')
                 return redirect(url_for('edit_tenant', tenant_id=tenant_id))
 
@@ -1075,28 +1675,25 @@ def edit_tenant(tenant_id):
 
         contract_start = request.form.get('contract_start') or None
         contract_end = request.form.get('contract_end') or None
-        tenant.contract_start = datetime.strptime(contract_start, '%Y-%m-%d') if contract_start else None
-        tenant.contract_end = datetime.strptime(contract_end, '%Y-%m-%d') if contract_end else None
+        tenant.contract_start = date.fromisoformat(contract_start) if contract_start else None
+        tenant.contract_end = date.fromisoformat(contract_end) if contract_end else None
 
         # Handle file upload if a new file is provided
         if 'contract_file' in request.files:
             file = request.files['contract_file']
             if file and file.filename:
-                filename = secure_filename(file.filename)
-                import time
-                timestamp = str(int(time.time()))
-                filename = f"{timestamp}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
-                tenant.contract_file = filename  # Store only the filename, not the full path
+                try:
+                    tenant.contract_file = save_contract_file(file)  # Store only the filename, not the full path
+                except FormError as e:
+                    flash(str(e), 'danger')
+                    return redirect(url_for('edit_tenant', tenant_id=tenant_id))
 
-        db.session.commit()
         db.session.add(AuditLog(action=f"تعديل مستأجر {tenant.name}", user='system'))
         db.session.commit()
         flash('تم تحديث المستأجر بنجاح.', 'success')
         return redirect(url_for('tenants_view'))
 
-    owners = Owner.query.all()
+    owners = owner_choices()
     return render_template('edit_tenant.html', tenant=tenant, owners=owners)
 
 @app.route('/delete_owner/<int:owner_id>', methods=['POST'])
@@ -1104,7 +1701,7 @@ def delete_owner(owner_id):
     owner = db.session.get(Owner, owner_id)
     if owner:
         # Check if owner has tenants
-        if owner.tenants:
+        if owner_has_tenant(owner_id):
             return {'success': False, 'message': 'لا يمكن حذف المالك لأنه مرتبط بمستأجرين'}, 400
 
         db.session.delete(owner)
@@ -1119,8 +1716,12 @@ def delete_tenant(tenant_id):
     if tenant:
         # Delete contract file if exists
         if tenant.contract_file:
+            # Identical uploads are stored once - keep the file while another tenant still uses it
+            shared = db.session.query(
+                Tenant.query.filter(Tenant.contract_file == tenant.contract_file, Tenant.id != tenant.id).exists()
+            ).scalar()
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], tenant.contract_file)
-            if os.path.exists(file_path):
+            if not shared and os.path.exists(file_path):
                 os.remove(file_path)
 
         db.session.delete(tenant)
@@ -1129,47 +1730,91 @@ def delete_tenant(tenant_id):
         return {'success': True}, 200
     return {'success': False}, 404
 
+def contract_path(filename):
+    """Resolve a stored contract name inside UPLOAD_FOLDER (None if it would escape it)"""
+    return safe_join(app.config['UPLOAD_FOLDER'], filename)
+
+def set_contract_cache_headers(response):
+    """Contract names are content hashes, so the browser may keep them (never shared caches)"""
+    response.cache_control.private = True
+    response.cache_control.max_age = CONTRACT_CACHE_MAX_AGE
+
+def content_disposition(kind, filename, fallback=None):
+    """Build a Content-Disposition header with an ASCII filename and the RFC 5987 UTF-8 name"""
+    if fallback is None:
+        fallback = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+    fallback = ''.join(c for c in fallback if c.isprintable()).replace('\\', '\\\\').replace('"', '\\"')
+    return f"{kind}; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+def send_contract_file(filename, as_attachment, mimetype=None):
+    """Send a stored contract without copying its bytes through Python.
+
+    Behind nginx (CONTRACTS_ACCEL_REDIRECT set) only the headers are returned and
+    nginx serves the file itself. Otherwise the open file goes to the server's
+    wsgi.file_wrapper, which gunicorn serves with sendfile(2); servers without
+    sendfile (TLS, dev server) read it in CONTRACT_STREAM_BUFSIZE blocks instead
+    of send_file's 8 KiB default.
+    """
+    file_path = contract_path(filename)
+    if file_path is None:
+        raise NotFound()
+    mimetype = mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    disposition = content_disposition('attachment' if as_attachment else 'inline', filename)
+
+    accel_prefix = app.config.get('CONTRACTS_ACCEL_REDIRECT')
+    if accel_prefix:
+        response = Response(mimetype=mimetype)
+        response.headers['Content-Disposition'] = disposition
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + quote(filename)
+        set_contract_cache_headers(response)
+        return response
+
+    # فتح الملف مباشرة يغني عن فحص وجوده مسبقاً (stat إضافي)
+    try:
+        fp = open(file_path, 'rb')
+    except (FileNotFoundError, IsADirectoryError):
+        raise NotFound()
+    stat = os.fstat(fp.fileno())
+    response = Response(wrap_file(request.environ, fp, CONTRACT_STREAM_BUFSIZE),
+                        mimetype=mimetype, direct_passthrough=True)
+    response.headers['Content-Disposition'] = disposition
+    response.content_length = stat.st_size
+    response.last_modified = int(stat.st_mtime)
+    response.set_etag(f"{stat.st_mtime}-{stat.st_size}")
+    set_contract_cache_headers(response)
+    # يدعم طلبات Range (عارضات PDF) و 304 للنسخ المخزنة في المتصفح
+    return response.make_conditional(request.environ, accept_ranges=True, complete_length=stat.st_size)
+
 @app.route('/uploads/contracts/<filename>')
 def download_contract(filename):
     # Extract filename from path if it contains directory separators
-    clean_filename = filename.split('\\')[-1].split('/')[-1]
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], clean_filename), as_attachment=True)
+    clean_filename = os.path.basename(filename.replace('\\', '/'))
+    return send_contract_file(clean_filename, as_attachment=True)
 
 @app.route('/serve_contract/<filename>')
 def serve_contract(filename):
     """Serve contract file inline for viewing in browser"""
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if not os.path.exists(file_path):
-        return "File not found", 404
-
-    file_ext = filename.lower().split('.')[-1]
-    mime_types = {
-        'pdf': 'application/pdf',
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'png': 'image/png',
-        'gif': 'image/gif'
-    }
-
-    mime_type = mime_types.get(file_ext, 'application/octet-stream')
-    return send_file(file_path, mimetype=mime_type, as_attachment=False)
+    file_ext = filename.rpartition('.')[2].lower()
+    mime_type = CONTRACT_MIME_TYPES.get(file_ext, 'application/octet-stream')
+    return send_contract_file(filename, as_attachment=False, mimetype=mime_type)
 
 @app.route('/view_contract/<filename>')
 def view_contract(filename):
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if not os.path.exists(file_path):
+    # Get file information (stat واحد يتحقق من الوجود ويعطي تاريخ التعديل)
+    file_path = contract_path(filename)
+    try:
+        file_stats = os.stat(file_path) if file_path else None
+    except FileNotFoundError:
+        file_stats = None
+    if file_stats is None:
         flash('الملف غير موجود.', 'error')
         return redirect(url_for('tenants_view'))
 
-    # Get file information
-    file_ext = filename.lower().split('.')[-1]
-    file_stats = os.stat(file_path)
+    file_ext = filename.rpartition('.')[2].lower()
     upload_date = datetime.fromtimestamp(file_stats.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
 
     # Determine if file can be viewed inline
-    viewable_types = ['pdf', 'jpg', 'jpeg', 'png', 'gif']
-
-    if file_ext in viewable_types:
+    if file_ext in VIEWABLE_CONTRACT_EXTS:
         # Render the view template for supported file types
         return render_template('view_contract.html',
                              filename=filename,
@@ -1181,6 +1826,8 @@ def view_contract(filename):
         return redirect(url_for('download_contract', filename=filename))
 
 # إدارة المشاريع والوحدات
+UNITS_PER_PAGE = 10
+
 @app.route('/projects', methods=['GET','POST'])
 def projects_view():
     if request.method == 'POST':
@@ -1216,14 +1863,9 @@ def projects_view():
 
     # Filter projects
     projects_query = Project.query
-    if search:
-        projects_query = projects_query.filter(
-            db.or_(
-                Project.name.contains(search),
-                Project.location.contains(search),
-                Project.description.contains(search)
-            )
-        )
+    project_search = search.replace(PROJECT_SEARCH_SEPARATOR, '')
+    if project_search:
+        projects_query = projects_query.filter(project_search_text.contains(project_search))
     projects = projects_query.all()
 
     # Filter and paginate units
@@ -1233,51 +1875,60 @@ def projects_view():
     if project_filter:
         units_query = units_query.filter(Unit.project_id == int(project_filter))
 
-    # Pagination for units
-    page = int(request.args.get('page', 1))
-    per_page = 10
-    units_paginated = units_query.paginate(page=page, per_page=per_page, error_out=False)
-    units = units_paginated.items
-    total_pages = units_paginated.pages
-
-    owners = Owner.query.all()
-    tenants = Tenant.query.all()
+    # Keyset pagination for units - seek by id instead of OFFSET + COUNT(*)
+    # صف إضافي واحد يكفي لمعرفة وجود صفحة تالية/سابقة
+    after_id = request.args.get('after', type=int)
+    before_id = request.args.get('before', type=int)
+    if before_id:
+        rows = units_query.filter(Unit.id < before_id).order_by(Unit.id.desc()).limit(UNITS_PER_PAGE + 1).all()
+        units = rows[:UNITS_PER_PAGE][::-1]
+        has_prev = len(rows) > UNITS_PER_PAGE
+        has_next = bool(units)
+    else:
+        if after_id:
+            units_query = units_query.filter(Unit.id > after_id)
+        rows = units_query.order_by(Unit.id).limit(UNITS_PER_PAGE + 1).all()
+        units = rows[:UNITS_PER_PAGE]
+        has_next = len(rows) > UNITS_PER_PAGE
+        has_prev = bool(after_id) and bool(units)
+
+    # القوائم تعرض المعرف والاسم فقط
+    owners = owner_choices()
+    tenants = tenant_choices()
     return render_template('projects.html', projects=projects, units=units, owners=owners, tenants=tenants,
-                           page=page, total_pages=total_pages, active_page='projects')
+                           has_prev=has_prev, has_next=has_next, active_page='projects')
 
 @app.route('/add_unit', methods=['POST'])
 def add_unit():
     try:
-        project_id = request.form.get('project_id')
-        unit_number = request.form.get('unit_number')
-        area = request.form.get('area')
+        form = UnitForm.from_form(request.form)
 
         # Validation
-        if not project_id:
+        if form.project_id is None:
             flash('يجب اختيار المشروع.', 'error')
             return redirect(url_for('projects_view'))
 
-        if not unit_number or len(unit_number.strip()) == 0:
+        if not form.unit_number:
             flash('يجب إدخال رقم الوحدة.', 'error')
             return redirect(url_for('projects_view'))
 
         # Check if unit number already exists in the project
-        existing_unit = Unit.query.filter_by(project_id=int(project_id), unit_number=unit_number.strip()).first()
+        existing_unit = Unit.query.filter_by(project_id=form.project_id, unit_number=form.unit_number).first()
         if existing_unit:
             flash('رقم الوحدة موجود بالفعل في هذا المشروع.', 'error')
             return redirect(url_for('projects_view'))
 
-        if area and float(area) <= 0:
+        if form.area is not None and form.area <= 0:
             flash('يجب أن تكون المساحة أكبر من صفر.', 'error')
             return redirect(url_for('projects_view'))
 
         unit = Unit(
-            project_id=int(project_id),
-            unit_number=unit_number.strip(),
-            type=request.form.get('type'),
-            area=float(area) if area else 0,
-            owner_id=int(request.form.get('owner_id')) if request.form.get('owner_id') else None,
-            status=request.form.get('status') or 'available'
+            project_id=form.project_id,
+            unit_number=form.unit_number,
+            type=form.type,
+            area=form.area or 0,
+            owner_id=form.owner_id,
+            status=form.status or 'available'
         )
         db.session.add(unit)
         db.session.commit()
@@ -1300,7 +1951,6 @@ def edit_project(project_id):
         project.name = request.form.get('name')
         project.location = request.form.get('location')
         project.description = request.form.get('description')
-        db.session.commit()
         db.session.add(AuditLog(action=f"تعديل مشروع {project.name}", user='system'))
         db.session.commit()
         flash('تم تحديث المشروع بنجاح.', 'success')
@@ -1315,10 +1965,9 @@ def delete_project(project_id):
         flash('المشروع غير موجود.', 'error')
         return redirect(url_for('projects_view'))
 
-    # Check if project has units
-    units_count = Unit.query.filter_by(project_id=project_id).count()
-    if units_count > 0:
-        flash(f'لا يمكن حذف المشروع لأنه يحتوي على {units_count} وحدة.', 'error')
+    # Check if project has units (EXISTS stops at the first match)
+    if db.session.query(Unit.query.filter_by(project_id=project_id).exists()).scalar():
+        flash('لا يمكن حذف المشروع لأنه يحتوي على وحدات.', 'error')
         return redirect(url_for('projects_view'))
 
     db.session.delete(project)
@@ -1334,19 +1983,27 @@ def edit_unit(unit_id):
         flash('الوحدة غير موجودة.', 'error')
         return redirect(url_for('projects_view'))
 
-    projects = Project.query.all()
-    owners = Owner.query.all()
-    tenants = Tenant.query.all()
+    projects = project_choices()
+    owners = owner_choices()
+    tenants = tenant_choices()
 
     if request.method == 'POST':
-        unit.project_id = int(request.form.get('project_id'))
-        unit.unit_number = request.form.get('unit_number')
-        unit.type = request.form.get('type')
-        unit.area = float(request.form.get('area') or 0)
-        unit.owner_id = int(request.form.get('owner_id')) if request.form.get('owner_id') else None
-        unit.tenant_id = int(request.form.get('tenant_id')) if request.form.get('tenant_id') else None
-        unit.status = request.form.get('status')
-        db.session.commit()
+        try:
+            form = UnitForm.from_form(request.form)
+        except FormError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('edit_unit', unit_id=unit_id))
+        if form.project_id is None:
+            flash('يجب اختيار المشروع.', 'error')
+            return redirect(url_for('edit_unit', unit_id=unit_id))
+
+        unit.project_id = form.project_id
+        unit.unit_number = form.unit_number
+        unit.type = form.type
+        unit.area = form.area or 0
+        unit.owner_id = form.owner_id
+        unit.tenant_id = form.tenant_id
+        unit.status = form.status
         db.session.add(AuditLog(action=f"تعديل وحدة {unit.unit_number}", user='system'))
         db.session.commit()
         flash('تم تحديث الوحدة بنجاح.', 'success')
@@ -1361,10 +2018,9 @@ def delete_unit(unit_id):
         flash('الوحدة غير موجودة.', 'error')
         return redirect(url_for('projects_view'))
 
-    # Check if unit has payments
-    payments_count = Payment.query.filter_by(unit_id=unit_id).count()
-    if payments_count > 0:
-        flash(f'لا يمكن حذف الوحدة لأنها تحتوي على {payments_count} دفعة.', 'error')
+    # Check if unit has payments (EXISTS stops at the first match)
+    if db.session.query(Payment.query.filter_by(unit_id=unit_id).exists()).scalar():
+        flash('لا يمكن حذف الوحدة لأنها تحتوي على دفعات.', 'error')
         return redirect(url_for('projects_view'))
 
     db.session.delete(unit)
@@ -1374,70 +2030,84 @@ def delete_unit(unit_id):
     return redirect(url_for('projects_view'))
 
 # تسجيل دفعات
+PAYMENTS_PER_PAGE = 10
+
+def parse_cursor_date(value):
+    """تاريخ مؤشر الصفحة من الرابط - القيمة غير الصالحة تُتجاهل فتُعرض الصفحة الأولى"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+def payer_name_column():
+    """اسم الدافع (مالك أو مستأجر) كعمود محسوب باستعلامات فرعية مرتبطة بالدفعة"""
+    return db.func.coalesce(db.case(
+        (Payment.payer_type == 'owner',
+         db.select(Owner.name).where(Owner.id == Payment.payer_id).scalar_subquery()),
+        (Payment.payer_type == 'tenant',
+         db.select(Tenant.name).where(Tenant.id == Payment.payer_id).scalar_subquery()),
+    ), 'غير محدد').label('payer_name')
+
 @app.route('/payments', methods=['GET','POST'])
 @login_required
 @limiter.limit("100 per hour")
 def payments_view():
-    units = Unit.query.all()
-    owners_query = Owner.query.all()
-    tenants_query = Tenant.query.all()
-    owners = [{'id': o.id, 'name': o.name, 'national_id': o.national_id} for o in owners_query]
-    tenants = [{'id': t.id, 'name': t.name} for t in tenants_query]
-    projects = Project.query.all()
-
-    # فلترة الدفعات
-    query = Payment.query
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    project_id = request.args.get('project_id')
+    # فلترة الدفعات - الوحدات تُحمل باستعلام واحد، وأي تحميل كسول آخر يرفع استثناء
+    # اسم الدافع يُجلب في نفس الاستعلام، فكل صف هو (payment, payer_name)
+    query = Payment.query.options(selectinload(Payment.unit), raiseload('*')).add_columns(payer_name_column())
+    # نفس فلاتر التاريخ والمشروع المستخدمة في التقارير والتصدير
+    query = filter_payments(query, *report_filter_args())
     search = request.args.get('search', '')
-
-    if start_date:
-        query = query.filter(Payment.date >= datetime.strptime(start_date, '%Y-%m-%d'))
-    if end_date:
-        query = query.filter(Payment.date <= datetime.strptime(end_date, '%Y-%m-%d'))
-    if project_id:
-        query = query.join(Unit).filter(Unit.project_id == int(project_id))
     if search:
-        # البحث في الوصف أو المبلغ
-        query = query.filter(
-            db.or_(
-                Payment.description.contains(search),
-                Payment.amount.cast(db.String).contains(search)
-            )
-        )
-
-    # Pagination
-    page = int(request.args.get('page', 1))
-    per_page = 10
-    payments_paginated = query.order_by(Payment.date.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    payments = payments_paginated.items
-    total_pages = payments_paginated.pages
-
-    # Create dictionaries for efficient lookup
-    owners_dict = {owner.id: owner for owner in owners_query}
-    tenants_dict = {tenant.id: tenant for tenant in tenants_query}
-
-    # Add payer names to payments for efficient template rendering
-    for payment in payments:
-        if payment.payer_type == 'owner' and payment.payer_id in owners_dict:
-            payment.payer_name = owners_dict[payment.payer_id].name
-        elif payment.payer_type == 'tenant' and payment.payer_id in tenants_dict:
-            payment.payer_name = tenants_dict[payment.payer_id].name
+        # ILIKE على PostgreSQL يستخدم فهرس الـ trigram على الوصف
+        description_filter = Payment.description.ilike(f"%{search}%")
+        # البحث في الوصف، وفي المبلغ بمطابقة رقمية إن كان النص رقماً
+        # (بدلاً من تحويل كل مبلغ إلى نص ومقارنته بـ LIKE)
+        try:
+            amount_filter = Payment.amount == float(search)
+        except ValueError:
+            amount_filter = None
+        if amount_filter is not None:
+            query = query.filter(db.or_(description_filter, amount_filter))
         else:
-            payment.payer_name = 'غير محدد'
+            query = query.filter(description_filter)
+
+    # Keyset pagination on (date, id) - seek past the cursor row instead of OFFSET + COUNT(*)
+    # صف إضافي واحد يكفي لمعرفة وجود صفحة تالية/سابقة
+    after_date = parse_cursor_date(request.args.get('after_date'))
+    after_id = request.args.get('after_id', type=int)
+    before_date = parse_cursor_date(request.args.get('before_date'))
+    before_id = request.args.get('before_id', type=int)
+    if before_date and before_id:
+        rows = query.filter(db.or_(
+            Payment.date > before_date, db.and_(Payment.date == before_date, Payment.id > before_id)
+        )).order_by(Payment.date, Payment.id).limit(PAYMENTS_PER_PAGE + 1).all()
+        payments = rows[:PAYMENTS_PER_PAGE][::-1]
+        has_prev = len(rows) > PAYMENTS_PER_PAGE
+        has_next = bool(payments)
+    else:
+        if after_date and after_id:
+            query = query.filter(db.or_(
+                Payment.date < after_date, db.and_(Payment.date == after_date, Payment.id < after_id)
+            ))
+        rows = query.order_by(Payment.date.desc(), Payment.id.desc()).limit(PAYMENTS_PER_PAGE + 1).all()
+        payments = rows[:PAYMENTS_PER_PAGE]
+        has_next = len(rows) > PAYMENTS_PER_PAGE
+        has_prev = bool(after_date and after_id) and bool(payments)
+
+    # Attach the payer name selected alongside each payment for the template
+    for payment, payer_name in payments:
+        payment.payer_name = payer_name
+    payments = [payment for payment, _ in payments]
     if request.method == 'POST':
-        unit_id = int(request.form.get('unit_id'))
-        payer_type = request.form.get('payer_type')
-        payer_id = int(request.form.get('payer_id')) if request.form.get('payer_id') else None
-        amount = float(request.form.get('amount') or 0)
-        company_rate = float(request.form.get('company_rate') or 0.05)
-        vat_rate = float(request.form.get('vat_rate') or 0.15)
-        payment_date = request.form.get('payment_date')
-        if payment_date:
-            payment_date = datetime.strptime(payment_date, '%Y-%m-%d')
-        else:
-            payment_date = datetime.now(timezone.utc)
+        try:
+            form = PaymentForm.from_form(request.form, default_date=datetime.now(timezone.utc))
+        except FormError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('payments_view'))
+        unit_id, payer_type, payer_id, amount = form.unit_id, form.payer_type, form.payer_id, form.amount
 
         # التحقق من صحة payer_id
         if payer_type == 'owner':
@@ -1452,19 +2122,21 @@ def payments_view():
                 return redirect(url_for('payments_view'))
 
         # حساب القيم
-        comm, vat, net = calculate_payment_breakdown(amount, company_rate, vat_rate)
+        comm, vat, net = calculate_payment_breakdown(amount, form.company_rate, form.vat_rate)
         p = Payment(unit_id=unit_id, payer_type=payer_type, payer_id=payer_id, amount=amount,
-                    description=request.form.get('description'),
-                    company_rate=company_rate, vat_rate=vat_rate,
+                    description=form.description,
+                    company_rate=form.company_rate, vat_rate=form.vat_rate,
                     company_commission=comm, vat_on_commission=vat, net_to_owner=net,
-                    date=payment_date)
+                    date=form.payment_date)
         db.session.add(p)
         db.session.add(AuditLog(action=f"تسجيل دفعة للوحدة {unit_id} مبلغ {amount}", user='system'))
         db.session.commit()
         flash('تم تسجيل الدفعة بنجاح.', 'success')
         return redirect(url_for('payments_view'))
-    return render_template('payments.html', units=units, owners=owners, tenants=tenants, payments=payments, projects=projects,
-                           page=page, total_pages=total_pages, search=search, active_page='payments')
+    # قوائم الاختيار محفوظة مؤقتاً (choices_cache)
+    # قائمة الدافعين (ملاك/مستأجرين) تُحمّل من /api/payers عند فتح النموذج بدلاً من تضمينها في الصفحة
+    return render_template('payments.html', units=unit_choices(), payments=payments, projects=project_choices(),
+                           has_prev=has_prev, has_next=has_next, search=search, active_page='payments')
 
 @app.route('/delete_payment/<int:payment_id>', methods=['DELETE'])
 def delete_payment(payment_id):
@@ -1483,22 +2155,18 @@ def edit_payment(payment_id):
         flash('الدفعة غير موجودة.', 'error')
         return redirect(url_for('payments_view'))
 
-    units = Unit.query.all()
-    owners = [{'id': o.id, 'name': o.name, 'national_id': o.national_id} for o in Owner.query.all()]
-    tenants = [{'id': t.id, 'name': t.name} for t in Tenant.query.all()]
+    units = unit_choices()
+    # القالب يمرر القوائم إلى JavaScript عبر tojson - قواميس بدلاً من صفوف
+    owners = [{'id': o.id, 'name': o.name, 'national_id': o.national_id} for o in owner_choices()]
+    tenants = [{'id': t.id, 'name': t.name} for t in tenant_choices()]
 
     if request.method == 'POST':
-        unit_id = int(request.form.get('unit_id'))
-        payer_type = request.form.get('payer_type')
-        payer_id = int(request.form.get('payer_id')) if request.form.get('payer_id') else None
-        amount = float(request.form.get('amount') or 0)
-        company_rate = float(request.form.get('company_rate') or 0.05)
-        vat_rate = float(request.form.get('vat_rate') or 0.15)
-        payment_date = request.form.get('payment_date')
-        if payment_date:
-            payment_date = datetime.strptime(payment_date, '%Y-%m-%d')
-        else:
-            payment_date = payment.date
+        try:
+            form = PaymentForm.from_form(request.form, default_date=payment.date)
+        except FormError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('edit_payment', payment_id=payment_id))
+        payer_type, payer_id = form.payer_type, form.payer_id
 
         # Validation
         if payer_type == 'owner':
@@ -1513,22 +2181,21 @@ def edit_payment(payment_id):
                 return redirect(url_for('edit_payment', payment_id=payment_id))
 
         # Update payment
-        payment.unit_id = unit_id
+        payment.unit_id = form.unit_id
         payment.payer_type = payer_type
         payment.payer_id = payer_id
-        payment.amount = amount
-        payment.company_rate = company_rate
-        payment.vat_rate = vat_rate
-        payment.date = payment_date
-        payment.description = request.form.get('description')
+        payment.amount = form.amount
+        payment.company_rate = form.company_rate
+        payment.vat_rate = form.vat_rate
+        payment.date = form.payment_date
+        payment.description = form.description
 
         # Recalculate
-        comm, vat, net = calculate_payment_breakdown(amount, company_rate, vat_rate)
+        comm, vat, net = calculate_payment_breakdown(form.amount, form.company_rate, form.vat_rate)
         payment.company_commission = comm
         payment.vat_on_commission = vat
         payment.net_to_owner = net
 
-        db.session.commit()
         db.session.add(AuditLog(action=f"تعديل دفعة {payment_id}", user='system'))
         db.session.commit()
         flash('تم تحديث الدفعة بنجاح.', 'success')
@@ -1536,38 +2203,82 @@ def edit_payment(payment_id):
 
     return render_template('edit_payment.html', payment=payment, units=units, owners=owners, tenants=tenants)
 
-# تقرير وتصدير
-@app.route('/reports')
-def reports_view():
-    # فلترة بسيطة ممكن توسيعها بواسطة باراميترات GET (project, owner, date range...)
-    query = Payment.query
+@app.route('/admin/recompute_payments', methods=['POST'])
+@login_required
+def recompute_payments():
+    """إعادة احتساب العمولة والضريبة والصافي لجميع الدفعات من النسب المحفوظة"""
+    if g.user_role != 'Admin':
+        flash('ليس لديك صلاحية للوصول إلى هذه الصفحة.', 'danger')
+        return redirect(url_for('dashboard'))
 
-    # فلاتر
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    project_id = request.args.get('project_id')
-    payer_type = request.args.get('payer_type')
+    rows = db.session.query(
+        Payment.id,
+        Payment.amount,
+        db.func.coalesce(Payment.company_rate, 0.05),
+        db.func.coalesce(Payment.vat_rate, 0.15)
+    ).all()
+    if rows:
+        ids, amounts, company_rates, vat_rates = zip(*rows)
+        comms, vats, nets = calculate_payment_breakdown_batch(amounts, company_rates, vat_rates)
+        db.session.bulk_update_mappings(Payment, [
+            {'id': payment_id, 'company_commission': comm, 'vat_on_commission': vat, 'net_to_owner': net}
+            for payment_id, comm, vat, net in zip(ids, comms.tolist(), vats.tolist(), nets.tolist())
+        ])
+        # bulk_update_mappings لا يطلق أحداث الـ mapper، فنعلّم الجلسة يدوياً ليُفرّغ بعد الـ commit
+        db.session.info['caches_stale'] = True
+
+    db.session.add(AuditLog(action=f"إعادة احتساب عمولات {len(rows)} دفعة", user=g.username))
+    db.session.commit()
+    flash(f'تمت إعادة احتساب {len(rows)} دفعة بنجاح.', 'success')
+    return redirect(url_for('reports_view'))
 
+# تقرير وتصدير
+def report_filter_args():
+    """باراميترات الفلترة المشتركة بين صفحة التقارير وملفات التصدير"""
+    args = request.args
+    return args.get('start_date'), args.get('end_date'), args.get('project_id'), args.get('payer_type')
+
+def filter_payments(query, start_date=None, end_date=None, project_id=None, payer_type=None):
+    """تطبيق فلاتر التاريخ والمشروع ونوع الدافع على استعلام الدفعات"""
+    # التواريخ تأتي من حقل date بصيغة ISO - fromisoformat أسرع بكثير من strptime
     if start_date:
-        query = query.filter(Payment.date >= datetime.strptime(start_date, '%Y-%m-%d'))
+        query = query.filter(Payment.date >= datetime.fromisoformat(start_date))
     if end_date:
-        query = query.filter(Payment.date <= datetime.strptime(end_date, '%Y-%m-%d'))
+        query = query.filter(Payment.date < date_range_end(end_date))
     if project_id:
         # فلترة حسب المشروع عبر الوحدات
         query = query.join(Unit).filter(Unit.project_id == int(project_id))
     if payer_type:
         query = query.filter(Payment.payer_type == payer_type)
+    return query
 
-    payments = query.order_by(Payment.date.desc()).all()
+REPORT_TABLE_LIMIT = 100  # عدد الدفعات المعروضة في جدول التقارير
 
-    # ملخصات
-    total_payments = sum(p.amount for p in payments) if payments else 0
-    total_commissions = sum(p.company_commission for p in payments) if payments else 0
-    total_vat = sum(p.vat_on_commission for p in payments) if payments else 0
-    net_to_owners = sum(p.net_to_owner for p in payments) if payments else 0
+@app.route('/reports')
+def reports_view():
+    # فلترة بسيطة ممكن توسيعها بواسطة باراميترات GET (project, owner, date range...)
+    # الجدول يعرض أعمدة الدفعة فقط، لذا يُمنع أي تحميل كسول للعلاقات
+    query = Payment.query.options(raiseload('*'))
+
+    # فلاتر
+    start_date, end_date, project_id, payer_type = report_filter_args()
+    query = filter_payments(query, start_date, end_date, project_id, payer_type)
+
+    # الجدول يعرض أحدث الدفعات فقط؛ الإجماليات تغطي كل الدفعات المفلترة والتصدير يعطي القائمة كاملة
+    payments = query.order_by(Payment.date.desc()).limit(REPORT_TABLE_LIMIT).all()
+
+    # ملخصات - استعلام تجميع واحد بنفس الفلاتر بدلاً من الجمع على الكائنات في بايثون
+    *sums, payments_count = query.with_entities(
+        db.func.sum(Payment.amount),
+        db.func.sum(Payment.company_commission),
+        db.func.sum(Payment.vat_on_commission),
+        db.func.sum(Payment.net_to_owner),
+        db.func.count(Payment.id)
+    ).one()
+    total_payments, total_commissions, total_vat, net_to_owners = (value or 0 for value in sums)
 
     # قائمة المشاريع للفلترة
-    projects = Project.query.all()
+    projects = project_choices()
 
     # توليد التقرير النصي الشامل
     text_report = generate_comprehensive_report(start_date, end_date, project_id, payer_type)
@@ -1575,169 +2286,344 @@ def reports_view():
     return render_template('reports.html', payments=payments, total_payments=total_payments,
                            total_commissions=total_commissions, total_vat=total_vat,
                            net_to_owners=net_to_owners, projects=projects, text_report=text_report,
+                           payments_count=payments_count, table_limit=REPORT_TABLE_LIMIT,
                            active_page='reports')
 
+def export_payment_rows(filters):
+    """أعمدة ملف التصدير للدفعات المفلترة كصفوف خفيفة بدلاً من كائنات Payment، تُقرأ على دفعات"""
+    query = db.session.query(
+        Payment.id, Payment.unit_id, Payment.payer_type, Payment.amount, Payment.date,
+        Payment.company_commission, Payment.vat_on_commission, Payment.net_to_owner,
+        Payment.description
+    )
+    return filter_payments(query, *filters).order_by(Payment.date.desc()).yield_per(EXPORT_BATCH_SIZE)
+
 @app.route('/export/payments/csv')
 def export_payments_csv():
-    query = Payment.query
-
     # نفس الفلاتر من reports_view
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    project_id = request.args.get('project_id')
-    payer_type = request.args.get('payer_type')
-
-    if start_date:
-        query = query.filter(Payment.date >= datetime.strptime(start_date, '%Y-%m-%d'))
-    if end_date:
-        query = query.filter(Payment.date <= datetime.strptime(end_date, '%Y-%m-%d'))
-    if project_id:
-        query = query.join(Unit).filter(Unit.project_id == int(project_id))
-    if payer_type:
-        query = query.filter(Payment.payer_type == payer_type)
+    payments = export_payment_rows(report_filter_args())
+
+    def generate():
+        import csv  # يُستورد عند التصدير فقط
+
+        # نكتب الصفوف على دفعات بدلاً من تحميل كل الدفعات في الذاكرة
+        si = io.StringIO()
+        cw = csv.writer(si)
+        cw.writerow(["id","unit_id","payer_type","amount","date","company_commission","vat_on_commission","net_to_owner","description"])
+        writerow = cw.writerow
+        for p in payments:
+            writerow([p.id,p.unit_id,p.payer_type,p.amount,p.date.strftime("%Y-%m-%d %H:%M:%S"),p.company_commission,p.vat_on_commission,p.net_to_owner,p.description])
+            # الإرسال حسب حجم المخزن وليس عدد الصفوف، لأن طول الوصف يختلف من صف لآخر
+            if si.tell() >= EXPORT_CHUNK_BYTES:
+                yield si.getvalue().encode('utf-8')
+                si.seek(0)
+                si.truncate(0)
+        yield si.getvalue().encode('utf-8')
+
+    return Response(stream_with_context(generate()), mimetype='text/csv', direct_passthrough=True,
+                    headers={'Content-Disposition': 'attachment; filename=payments.csv'})
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+XLSX_DOWNLOAD_NAME = 'payments.xlsx'
+# الملف يبقى في الذاكرة حتى هذا الحجم ثم يُنقل إلى ملف مؤقت على القرص
+XLSX_SPOOL_MAX_SIZE = 10 * 1024 * 1024
+
+def build_payments_xlsx(output, filters):
+    """كتابة ملف Excel للدفعات المفلترة إلى output (مسار ملف أو ملف مفتوح)"""
+    import xlsxwriter  # استيراد كسول - لا يُحمّل مع إقلاع كل عامل
+    payments = export_payment_rows(filters)
+
+    # constant_memory يكتب كل صف إلى ملف مؤقت فور اكتماله دون الاحتفاظ بالخلايا في الذاكرة
+    wb = xlsxwriter.Workbook(output, {'constant_memory': True})
+    ws = wb.add_worksheet("الدفعات")
 
-    payments = query.order_by(Payment.date.desc()).all()
+    # Headers
+    ws.write_row(0, 0, ["ID", "الوحدة", "نوع الدافع", "المبلغ", "التاريخ", "عمولة الشركة", "ضريبة القيمة المضافة", "صافي للمالك", "الوصف"])
 
-    si = io.StringIO()
-    cw = csv.writer(si)
-    cw.writerow(["id","unit_id","payer_type","amount","date","company_commission","vat_on_commission","net_to_owner","description"])
-    for p in payments:
-        cw.writerow([p.id,p.unit_id,p.payer_type,p.amount,p.date.strftime("%Y-%m-%d %H:%M:%S"),p.company_commission,p.vat_on_commission,p.net_to_owner,p.description])
-    output = io.BytesIO()
-    output.write(si.getvalue().encode('utf-8'))
-    output.seek(0)
-    return send_file(output, mimetype='text/csv', download_name='payments.csv', as_attachment=True)
+    # Data
+    for row, payment in enumerate(payments, 1):
+        ws.write_row(row, 0, [
+            payment.id,
+            payment.unit_id,
+            payment.payer_type,
+            payment.amount,
+            payment.date.strftime("%Y-%m-%d %H:%M:%S"),
+            payment.company_commission,
+            payment.vat_on_commission,
+            payment.net_to_owner,
+            payment.description
+        ])
+
+    wb.close()
 
 @app.route('/export/payments/excel')
 def export_payments_excel():
-    query = Payment.query
-
     # نفس الفلاتر من reports_view
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    project_id = request.args.get('project_id')
-    payer_type = request.args.get('payer_type')
-
-    if start_date:
-        query = query.filter(Payment.date >= datetime.strptime(start_date, '%Y-%m-%d'))
-    if end_date:
-        query = query.filter(Payment.date <= datetime.strptime(end_date, '%Y-%m-%d'))
-    if project_id:
-        query = query.join(Unit).filter(Unit.project_id == int(project_id))
-    if payer_type:
-        query = query.filter(Payment.payer_type == payer_type)
+    output = tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_MAX_SIZE)
+    build_payments_xlsx(output, report_filter_args())
+    output.seek(0)
+    return send_file(output, mimetype=XLSX_MIMETYPE, download_name=XLSX_DOWNLOAD_NAME, as_attachment=True)
 
-    payments = query.order_by(Payment.date.desc()).all()
+# تصدير Excel في الخلفية
+def export_job_path(job_id):
+    return os.path.join(app.config['EXPORT_FOLDER'], f"{job_id}.xlsx")
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "الدفعات"
+def export_version_path():
+    return os.path.join(app.config['EXPORT_FOLDER'], 'data.version')
 
-    # Headers
-    headers = ["ID", "الوحدة", "نوع الدافع", "المبلغ", "التاريخ", "عمولة الشركة", "ضريبة القيمة المضافة", "صافي للمالك", "الوصف"]
-    for col_num, header in enumerate(headers, 1):
-        ws.cell(row=1, column=col_num, value=header)
+def export_data_version():
+    """إصدار البيانات المشترك بين العمال عبر القرص - يتغير بعد كل commit يعدّل البيانات"""
+    try:
+        with open(export_version_path()) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+def bump_export_data_version():
+    """تغيير إصدار البيانات فتحصل طلبات التصدير التالية على معرف جديد بدل ملف قديم"""
+    os.makedirs(app.config['EXPORT_FOLDER'], exist_ok=True)
+    path = export_version_path()
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'w') as f:
+        f.write(secrets.token_hex(8))
+    os.replace(tmp_path, path)
+
+def export_file_fresh(path, now=None):
+    """الملف الجاهز صالح فقط خلال EXPORT_CACHE_TTL من إنشائه"""
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        return False
+    return (now or time.time()) - mtime < EXPORT_CACHE_TTL
 
-    # Data
-    for row_num, payment in enumerate(payments, 2):
-        ws.cell(row=row_num, column=1, value=payment.id)
-        ws.cell(row=row_num, column=2, value=payment.unit_id)
-        ws.cell(row=row_num, column=3, value=payment.payer_type)
-        ws.cell(row=row_num, column=4, value=payment.amount)
-        ws.cell(row=row_num, column=5, value=payment.date.strftime("%Y-%m-%d %H:%M:%S"))
-        ws.cell(row=row_num, column=6, value=payment.company_commission)
-        ws.cell(row=row_num, column=7, value=payment.vat_on_commission)
-        ws.cell(row=row_num, column=8, value=payment.net_to_owner)
-        ws.cell(row=row_num, column=9, value=payment.description)
-
-    # Save to BytesIO
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', download_name='payments.xlsx', as_attachment=True)
+def remove_expired_exports(now):
+    """حذف ملفات التصدير المنتهية وملفات .part المتروكة (توقف عامل أثناء التصدير مثلاً)"""
+    try:
+        entries = list(os.scandir(app.config['EXPORT_FOLDER']))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if not entry.name.endswith(('.xlsx', '.xlsx.part')):
+            continue
+        try:
+            if now - entry.stat().st_mtime >= EXPORT_CACHE_TTL:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+def run_export_job(job_id, filters):
+    """يُنفذ في خيط الخلفية: يكتب إلى ملف .part ثم ينقله باسمه النهائي عند الاكتمال"""
+    path = export_job_path(job_id)
+    part_path = path + '.part'
+    with app.app_context():
+        try:
+            build_payments_xlsx(part_path, filters)
+            os.replace(part_path, path)
+        except Exception:
+            app.logger.exception("فشل تصدير Excel في الخلفية (%s)", job_id)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+def submit_export_job(filters):
+    """جدولة تصدير Excel وإرجاع معرفه - نفس الفلاتر ونفس إصدار البيانات تعطي نفس المعرف فيُعاد استخدام الملف"""
+    key = json.dumps([export_data_version(), filters])
+    job_id = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+    path = export_job_path(job_id)
+    part_path = path + '.part'
+    now = time.time()
+
+    if export_file_fresh(path, now):
+        return job_id
+    remove_expired_exports(now)
+
+    os.makedirs(app.config['EXPORT_FOLDER'], exist_ok=True)
+    try:
+        # O_EXCL يضمن أن عاملاً واحداً فقط ينشئ الملف لنفس الفلاتر
+        os.close(os.open(part_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return job_id
+    export_executor.submit(run_export_job, job_id, filters)
+    return job_id
 
-@app.route('/api/unit/<int:unit_id>')
-def get_unit_details(unit_id):
-    unit = db.session.get(Unit, unit_id)
-    if not unit:
-        return {'error': 'Unit not found'}, 404
+def valid_export_job_id(job_id):
+    return re.fullmatch(r'[0-9a-f]{32}', job_id) is not None
 
-    project = db.session.get(Project, unit.project_id) if unit.project_id else None
+@app.route('/export/payments/excel/async', methods=['POST'])
+@login_required
+def export_payments_excel_async():
+    job_id = submit_export_job(report_filter_args())
+    return {'job_id': job_id, 'status_url': url_for('export_status', job_id=job_id)}, 202
 
+@app.route('/export/status/<job_id>')
+@login_required
+def export_status(job_id):
+    if not valid_export_job_id(job_id):
+        return {'status': 'unknown'}, 404
+    path = export_job_path(job_id)
+    if export_file_fresh(path):
+        return {'status': 'ready', 'download_url': url_for('download_export', job_id=job_id)}, 200
+    if os.path.exists(path + '.part'):
+        return {'status': 'pending'}, 202
+    return {'status': 'unknown'}, 404
+
+@app.route('/export/download/<job_id>')
+@login_required
+def download_export(job_id):
+    if not valid_export_job_id(job_id):
+        raise NotFound()
+    path = export_job_path(job_id)
+    if not export_file_fresh(path):
+        raise NotFound()
+    return send_file(path, mimetype=XLSX_MIMETYPE, download_name=XLSX_DOWNLOAD_NAME, as_attachment=True)
+
+@app.route('/api/payers/<payer_type>')
+@login_required
+def get_payers(payer_type):
+    """قائمة الدافعين لنموذج إضافة دفعة - الأعمدة المعروضة فقط"""
+    if payer_type == 'owner':
+        return [{'id': o.id, 'name': o.name, 'national_id': o.national_id} for o in owner_choices()]
+    if payer_type == 'tenant':
+        return [{'id': t.id, 'name': t.name} for t in tenant_choices()]
+    return {'error': 'Unknown payer type'}, 404
+
+# تفاصيل الوحدة تتغير نادراً أثناء تعبئة النموذج، فتُحفظ في ذاكرة المتصفح لفترة قصيرة
+UNIT_DETAILS_CACHE_HEADERS = {'Cache-Control': 'private, max-age=30'}
+UNIT_DETAILS_BATCH_MAX = 100
+
+def query_unit_details():
+    """الوحدة مع اسم المشروع وبيانات المستأجر في استعلام واحد (outer joins)"""
+    return db.session.query(
+        Unit.id, Unit.unit_number, Unit.status, Unit.tenant_id, Project.name.label('project_name'),
+        Tenant.id.label('tenant_row_id'), Tenant.name.label('tenant_name'),
+        Tenant.contract_start, Tenant.contract_end
+    ).outerjoin(Unit.project).outerjoin(Tenant, Tenant.id == Unit.tenant_id)
+
+def unit_details_dict(row):
     unit_data = {
-        'id': unit.id,
-        'unit_number': unit.unit_number,
-        'project_name': project.name if project else '',
-        'status': unit.status,
-        'is_rented': unit.tenant_id is not None
+        'id': row.id,
+        'unit_number': row.unit_number,
+        'project_name': row.project_name or '',
+        'status': row.status,
+        'is_rented': row.tenant_id is not None
     }
 
-    if unit.tenant_id:
-        tenant = db.session.get(Tenant, unit.tenant_id)
-        if tenant:
-            unit_data['tenant'] = {
-                'id': tenant.id,
-                'name': tenant.name,
-                'contract_start': tenant.contract_start.strftime('%Y-%m-%d') if tenant.contract_start else None,
-                'contract_end': tenant.contract_end.strftime('%Y-%m-%d') if tenant.contract_end else None
-            }
-            # Assuming rent amount is not stored, but perhaps we can use a default or from contract
-            # For now, leave rent_amount as None
-            unit_data['rent_amount'] = None
-            unit_data['rent_date'] = tenant.contract_start.strftime('%Y-%m-%d') if tenant.contract_start else None
+    if row.tenant_row_id is not None:
+        contract_start = row.contract_start.strftime('%Y-%m-%d') if row.contract_start else None
+        unit_data['tenant'] = {
+            'id': row.tenant_row_id,
+            'name': row.tenant_name,
+            'contract_start': contract_start,
+            'contract_end': row.contract_end.strftime('%Y-%m-%d') if row.contract_end else None
+        }
+        # Assuming rent amount is not stored, but perhaps we can use a default or from contract
+        # For now, leave rent_amount as None
+        unit_data['rent_amount'] = None
+        unit_data['rent_date'] = contract_start
 
     return unit_data
 
+@app.route('/api/unit/<int:unit_id>')
+def get_unit_details(unit_id):
+    row = query_unit_details().filter(Unit.id == unit_id).first()
+    if not row:
+        return {'error': 'Unit not found'}, 404
+    return unit_details_dict(row), 200, UNIT_DETAILS_CACHE_HEADERS
+
+@app.route('/api/units')
+@login_required
+def get_units_details():
+    """تفاصيل عدة وحدات دفعة واحدة: /api/units?ids=1,2,3"""
+    try:
+        ids = {int(i) for i in request.args.get('ids', '').split(',') if i.strip()}
+    except ValueError:
+        return {'error': 'Invalid ids'}, 400
+    if len(ids) > UNIT_DETAILS_BATCH_MAX:
+        return {'error': f'At most {UNIT_DETAILS_BATCH_MAX} ids per request'}, 400
+    if not ids:
+        return [], 200, UNIT_DETAILS_CACHE_HEADERS
+    rows = query_unit_details().filter(Unit.id.in_(ids)).order_by(Unit.id).all()
+    return [unit_details_dict(row) for row in rows], 200, UNIT_DETAILS_CACHE_HEADERS
+
+# رأس وتذييل ملف التقرير النصي المُصدّر
+TEXT_EXPORT_CHUNK_CHARS = 16 * 1024  # عدد الأحرف المرمّزة في كل جزء (حتى ~32KB للنص العربي)
+TEXT_EXPORT_HEADER_FMT = "\n".join([
+    "=" * 100,
+    "ملف التقرير الشامل - شركة كثيب للاستثمار",
+    "تم التصدير في: {exported_at}",
+    "نوع الملف: تقرير نصي شامل",
+    "=" * 100,
+    "", "",
+])
+TEXT_EXPORT_FOOTER = "\n".join([
+    "",
+    "=" * 100,
+    "نهاية الملف المُصدّر",
+    "تم إنشاء هذا التقرير بواسطة نظام إدارة شركة كثيب للاستثمار",
+    "جميع الحقوق محفوظة © شركة كثيب للاستثمار",
+    "=" * 100,
+    "",
+])
+
 @app.route('/export/payments/text')
 def export_payments_text():
     # الحصول على الفلاتر من الطلب
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    project_id = request.args.get('project_id')
-    payer_type = request.args.get('payer_type')
+    start_date, end_date, project_id, payer_type = report_filter_args()
 
     # توليد التقرير النصي الشامل
     report_text = generate_comprehensive_report(start_date, end_date, project_id, payer_type)
 
-    # تحسين التنسيق للتصدير - إضافة رأس وتذييل باللغة العربية
-    export_header = "=" * 100 + "\n"
-    export_header += "ملف التقرير الشامل - شركة كثيب للاستثمار\n"
-    export_header += "تم التصدير في: " + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + "\n"
-    export_header += "نوع الملف: تقرير نصي شامل\n"
-    export_header += "=" * 100 + "\n\n"
-
-    export_footer = "\n" + "=" * 100 + "\n"
-    export_footer += "نهاية الملف المُصدّر\n"
-    export_footer += "تم إنشاء هذا التقرير بواسطة نظام إدارة شركة كثيب للاستثمار\n"
-    export_footer += "جميع الحقوق محفوظة © شركة كثيب للاستثمار\n"
-    export_footer += "=" * 100 + "\n"
-
-    # دمج الرأس والتقرير والتذييل
-    full_report = export_header + report_text + export_footer
-
-    # إرسال الملف مع ترميز UTF-8 لضمان عرض النص العربي بشكل صحيح
-    output = io.BytesIO()
-    output.write(full_report.encode('utf-8-sig'))  # استخدام utf-8-sig لدعم العربية في Windows
-    output.seek(0)
+    now = datetime.now()
 
-    # اسم الملف باللغة العربية مع التاريخ
-    filename = f"تقرير_شامل_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    def generate():
+        # BOM أولاً لدعم العربية في Windows، ثم الرأس والتقرير والتذييل كل على حدة
+        # بدلاً من دمجها في نص واحد ثم نسخه إلى bytes و BytesIO
+        # (نص التقرير نفسه كامل في الذاكرة لأنه محفوظ مؤقتاً؛ الترميز فقط يتم على أجزاء)
+        yield codecs.BOM_UTF8
+        yield TEXT_EXPORT_HEADER_FMT.format(exported_at=now.strftime('%Y-%m-%d %H:%M:%S')).encode('utf-8')
+        for i in range(0, len(report_text), TEXT_EXPORT_CHUNK_CHARS):
+            yield report_text[i:i + TEXT_EXPORT_CHUNK_CHARS].encode('utf-8')
+        yield TEXT_EXPORT_FOOTER.encode('utf-8')
 
-    return send_file(
-        output,
-        mimetype='text/plain; charset=utf-8',
-        download_name=filename,
-        as_attachment=True
-    )
+    # اسم الملف باللغة العربية مع التاريخ - يُرسل بصيغة RFC 5987 مع بديل ASCII
+    stamp = now.strftime('%Y%m%d_%H%M%S')
+    filename = f"تقرير_شامل_{stamp}.txt"
+    disposition = content_disposition('attachment', filename, fallback=f"report_{stamp}.txt")
+
+    return Response(generate(), content_type='text/plain; charset=utf-8', direct_passthrough=True,
+                    headers={'Content-Disposition': disposition})
 
 # -------------------------
 # تشغيل التطبيق وتهيئة DB
 # -------------------------
+def init_db_schema():
+    """إنشاء الجداول والفهارس الناقصة - آمن للتكرار، ويُشغَّل قبل كل نشر (flask --app app init-db)"""
+    db.create_all()
+    # create_all لا يضيف الفهارس الجديدة إلى الجداول الموجودة مسبقاً
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # PostgreSQL: فهارس trigram تخدم البحث النصي '%...%' في المشاريع ووصف الدفعات
+    if db.engine.dialect.name == 'postgresql':
+        try:
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                conn.exec_driver_sql(PROJECT_SEARCH_TRGM_INDEX)
+                conn.exec_driver_sql(PAYMENT_DESCRIPTION_TRGM_INDEX)
+        except Exception as e:
+            print(f"Search indexes not created: {e}")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and indexes (run by the deploy before gunicorn starts)"""
+    init_db_schema()
+    print("Database schema is up to date")
+
 if __name__ == '__main__':
     with app.app_context():
-        # Always recreate database for development (remove this in production)
-        db.create_all()
-        seed_sample_data()
+        init_db_schema()
+        # بيانات تجريبية: افتراضياً لقاعدة SQLite المحلية فقط، ويمكن التحكم بها عبر SEED_DB=1/0
+        if os.environ.get('SEED_DB', '0' if database_url else '1') == '1':
+            seed_sample_data()
 
         # Create upload folder if it doesn't exist
         if not os.path.exists(app.config['UPLOAD_FOLDER']):
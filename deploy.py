@@ -28,7 +28,9 @@ def check_database():
     """فحص الاتصال بقاعدة البيانات"""
     try:
         with app.app_context():
-            db.engine.execute('SELECT 1')
+            # engine.execute أُزيل في SQLAlchemy 2 - اتصال من المجمع (مع pool_pre_ping) ثم إعادته
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql('SELECT 1')
         print("✅ الاتصال بقاعدة البيانات ناجح")
         return True
     except Exception as e:
@@ -0,0 +1,49 @@
+// تصدير Excel في الخلفية: طلب المهمة (POST) ثم متابعة حالتها حتى يجهز الملف فيُحمّل
+// الرابط الأصلي (href) يبقى كبديل متزامن إن فشل الطلب
+document.querySelectorAll('a[data-async-export]').forEach(function (link) {
+    link.addEventListener('click', function (event) {
+        event.preventDefault();
+        if (link.classList.contains('disabled')) return;
+        var label = link.innerHTML;
+        link.classList.add('disabled');
+        link.textContent = '⏳ جاري تجهيز الملف...';
+
+        function done() {
+            link.classList.remove('disabled');
+            link.innerHTML = label;
+        }
+
+        function fallback() {
+            done();
+            window.location = link.href;
+        }
+
+        function poll(statusUrl) {
+            fetch(statusUrl, { credentials: 'same-origin' })
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    if (data.status === 'ready') {
+                        done();
+                        window.location = data.download_url;
+                    } else if (data.status === 'pending') {
+                        setTimeout(function () { poll(statusUrl); }, 1000);
+                    } else {
+                        fallback();
+                    }
+                })
+                .catch(fallback);
+        }
+
+        fetch(link.dataset.asyncExport, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'X-CSRFToken': link.dataset.csrfToken }
+        })
+            .then(function (response) {
+                if (!response.ok) throw new Error(response.status);
+                return response.json();
+            })
+            .then(function (data) { poll(data.status_url); })
+            .catch(fallback);
+    });
+});
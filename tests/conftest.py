@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app picks its database from DATABASE_URL at import time, so point it at a
+# throwaway SQLite file before importing (never at a real database)
+_DB_DIR = tempfile.mkdtemp(prefix='kathib-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_DB_DIR, 'test.db')
+os.environ.pop('RATELIMIT_STORAGE_URI', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as kathib  # noqa: E402
+
+# enforce_https redirects plain http, and the session cookie is Secure-only
+BASE_URL = 'https://localhost'
+
+
+@pytest.fixture(scope='session')
+def tables():
+    with kathib.app.app_context():
+        kathib.db.create_all()
+
+
+@pytest.fixture
+def app(tables, tmp_path):
+    kathib.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, EXPORT_FOLDER=str(tmp_path / 'exports'))
+    kathib.limiter.enabled = False
+    with kathib.app.app_context():
+        kathib.clear_dashboard_cache()
+        yield kathib.app
+        kathib.db.session.remove()
+        # Empty the tables rather than dropping them: the audit writer thread may still insert
+        with kathib.db.engine.begin() as conn:
+            for table in reversed(kathib.db.metadata.sorted_tables):
+                conn.execute(table.delete())
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user():
+    def make(username='admin', password='Secret123', role='Admin'):
+        user = kathib.User(username=username, role=role, name=username)
+        user.set_password(password)
+        kathib.db.session.add(user)
+        kathib.db.session.commit()
+        return user
+    return make
+
+
+@pytest.fixture
+def login(client, make_user):
+    def log_in():
+        user = make_user()
+        response = client.post('/login', data={'username': 'admin', 'password': 'Secret123'}, base_url=BASE_URL)
+        assert response.status_code == 302
+        return user
+    return log_in
+
+
+@pytest.fixture
+def unit(app):
+    owner = kathib.Owner(name='مالك')
+    project = kathib.Project(name='مشروع')
+    kathib.db.session.add_all([owner, project])
+    kathib.db.session.flush()
+    unit = kathib.Unit(project_id=project.id, unit_number='101', owner_id=owner.id)
+    kathib.db.session.add(unit)
+    kathib.db.session.commit()
+    return unit
+
+
+def add_payment(unit, amount, date, payer_type='owner'):
+    comm, vat, net = kathib.calculate_payment_breakdown(amount, 0.05, 0.15)
+    payment = kathib.Payment(unit_id=unit.id, payer_type=payer_type, payer_id=unit.owner_id, amount=amount,
+                             company_rate=0.05, vat_rate=0.15, company_commission=comm,
+                             vat_on_commission=vat, net_to_owner=net, date=date)
+    kathib.db.session.add(payment)
+    return payment
@@ -0,0 +1,103 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from conftest import BASE_URL, add_payment, kathib
+
+NO_FILTERS = (None, None, None, None)
+
+
+def wait_for_export(job_id, timeout=10):
+    path = kathib.export_job_path(job_id)
+    deadline = time.time() + timeout
+    while not kathib.export_file_fresh(path):
+        assert time.time() < deadline, 'export did not finish'
+        time.sleep(0.05)
+    return path
+
+
+def test_dashboard_cache_cleared_on_commit_only(app, unit):
+    add_payment(unit, 100, datetime(2024, 1, 1))
+    kathib.db.session.commit()
+    assert kathib.compute_dashboard_kpis().total_payments == 100
+
+    # A flushed but rolled back payment must not clear the cache
+    add_payment(unit, 50, datetime(2024, 1, 2))
+    kathib.db.session.flush()
+    kathib.db.session.rollback()
+    assert len(kathib.dashboard_cache) == 1
+    assert kathib.compute_dashboard_kpis().total_payments == 100
+
+    add_payment(unit, 50, datetime(2024, 1, 2))
+    kathib.db.session.flush()
+    assert len(kathib.dashboard_cache) == 1  # not yet committed
+    kathib.db.session.commit()
+    assert len(kathib.dashboard_cache) == 0
+    assert kathib.compute_dashboard_kpis().total_payments == 150
+
+
+def test_export_job_reused_until_data_changes(app, unit):
+    add_payment(unit, 100, datetime(2024, 1, 1))
+    kathib.db.session.commit()
+
+    job_id = kathib.submit_export_job(NO_FILTERS)
+    wait_for_export(job_id)
+    assert kathib.submit_export_job(NO_FILTERS) == job_id
+
+    # A rolled back change keeps the finished export
+    add_payment(unit, 50, datetime(2024, 1, 2))
+    kathib.db.session.flush()
+    kathib.db.session.rollback()
+    assert kathib.submit_export_job(NO_FILTERS) == job_id
+
+    add_payment(unit, 50, datetime(2024, 1, 2))
+    kathib.db.session.commit()
+    new_job_id = kathib.submit_export_job(NO_FILTERS)
+    assert new_job_id != job_id
+    wait_for_export(new_job_id)
+
+
+@pytest.mark.parametrize('view', ['export_status', 'download_export'])
+def test_expired_export_is_not_served(client, login, unit, view):
+    login()
+    add_payment(unit, 100, datetime(2024, 1, 1))
+    kathib.db.session.commit()
+    job_id = kathib.submit_export_job(NO_FILTERS)
+    path = wait_for_export(job_id)
+
+    url = {'export_status': f'/export/status/{job_id}', 'download_export': f'/export/download/{job_id}'}[view]
+    assert client.get(url, base_url=BASE_URL).status_code == 200
+
+    expired = time.time() - kathib.EXPORT_CACHE_TTL - 1
+    os.utime(path, (expired, expired))
+    assert client.get(url, base_url=BASE_URL).status_code == 404
+
+
+def test_expired_exports_are_removed(app, unit):
+    add_payment(unit, 100, datetime(2024, 1, 1))
+    kathib.db.session.commit()
+    path = wait_for_export(kathib.submit_export_job(NO_FILTERS))
+
+    expired = time.time() - kathib.EXPORT_CACHE_TTL - 1
+    os.utime(path, (expired, expired))
+    kathib.submit_export_job(('2024-01-01', None, None, None))
+    assert not os.path.exists(path)
+
+
+def test_async_export_flow(client, login, unit):
+    login()
+    add_payment(unit, 100, datetime(2024, 1, 1))
+    kathib.db.session.commit()
+
+    response = client.post('/export/payments/excel/async?payer_type=owner', base_url=BASE_URL)
+    assert response.status_code == 202
+    job = response.get_json()
+    wait_for_export(job['job_id'])
+
+    status = client.get(job['status_url'], base_url=BASE_URL)
+    assert status.get_json()['status'] == 'ready'
+    download = client.get(status.get_json()['download_url'], base_url=BASE_URL)
+    assert download.status_code == 200
+    assert download.data[:2] == b'PK'
@@ -0,0 +1,43 @@
+from conftest import BASE_URL, kathib
+
+
+def post_login(client, password):
+    return client.post('/login', data={'username': 'admin', 'password': password}, base_url=BASE_URL)
+
+
+def test_account_locks_after_max_failed_attempts(client, make_user):
+    make_user()
+    for _ in range(kathib.LOGIN_MAX_ATTEMPTS):
+        post_login(client, 'Wrong1234')
+
+    user = kathib.User.query.filter_by(username='admin').one()
+    assert user.login_attempts == kathib.LOGIN_MAX_ATTEMPTS
+    assert user.is_account_locked()
+
+    # Even the right password is refused while the lock lasts
+    response = post_login(client, 'Secret123')
+    assert response.status_code == 200
+    assert 'الحساب مقفل مؤقتاً' in response.get_data(as_text=True)
+
+
+def test_failed_attempts_are_counted_in_the_database(app, make_user):
+    # The default memory:// limiter storage is per worker, so the count must live in the DB
+    assert not kathib.LOGIN_COUNTER_SHARED
+    user = make_user()
+    assert [user.increment_login_attempts() for _ in range(3)] == [1, 2, 3]
+    kathib.db.session.commit()
+    assert kathib.db.session.get(kathib.User, user.id).login_attempts == 3
+    assert not user.is_account_locked()
+
+
+def test_successful_login_resets_attempts(client, make_user):
+    make_user()
+    post_login(client, 'Wrong1234')
+    post_login(client, 'Wrong1234')
+
+    response = post_login(client, 'Secret123')
+    assert response.status_code == 302
+
+    user = kathib.User.query.filter_by(username='admin').one()
+    assert user.login_attempts == 0
+    assert user.locked_until is None
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from conftest import kathib
+
+
+def sample_inputs(size=5000, seed=1234):
+    rng = np.random.default_rng(seed)
+    amounts = np.round(rng.uniform(0, 100000, size), 2)
+    # Amounts that land exactly on half a halala after applying the rates
+    amounts = np.concatenate([amounts, [0.1, 0.5, 1.05, 2.5, 10.01, 12.345, 1000.05]])
+    company_rates = rng.choice([0.0, 0.025, 0.05, 0.075, 0.1], amounts.shape)
+    vat_rates = rng.choice([0.0, 0.05, 0.15], amounts.shape)
+    return amounts, company_rates, vat_rates
+
+
+@pytest.fixture(params=['numpy', 'numba'])
+def breakdown_path(request, monkeypatch):
+    """Run the batch tests through the NumPy fallback and, when installed, the Numba kernel"""
+    if request.param == 'numba':
+        pytest.importorskip('numba')
+        assert kathib.NUMBA_AVAILABLE
+    else:
+        monkeypatch.setattr(kathib, 'NUMBA_AVAILABLE', False)
+    return request.param
+
+
+def test_batch_matches_scalar_breakdown(breakdown_path):
+    amounts, company_rates, vat_rates = sample_inputs()
+
+    comms, vats, nets = kathib.calculate_payment_breakdown_batch(amounts, company_rates, vat_rates)
+
+    for amount, company_rate, vat_rate, comm, vat, net in zip(
+            amounts.tolist(), company_rates.tolist(), vat_rates.tolist(),
+            comms.tolist(), vats.tolist(), nets.tolist()):
+        assert (comm, vat, net) == kathib.calculate_payment_breakdown(amount, company_rate, vat_rate)
+
+
+def test_batch_broadcasts_scalar_rates(breakdown_path):
+    amounts = [100.0, 250.5, 999.99]
+    comms, vats, nets = kathib.calculate_payment_breakdown_batch(amounts, 0.05, 0.15)
+    assert list(zip(comms.tolist(), vats.tolist(), nets.tolist())) == [
+        kathib.calculate_payment_breakdown(amount, 0.05, 0.15) for amount in amounts
+    ]
+
+
+def test_numba_kernel_matches_numpy_rounding():
+    # Compare the kernel's raw output, before the tie rows are recomputed, with _round_cents
+    pytest.importorskip('numba')
+    amounts, company_rates, vat_rates = sample_inputs()
+    commissions, vats, nets = (np.empty_like(amounts) for _ in range(3))
+    ties = np.empty(amounts.shape, dtype=np.bool_)
+    kathib._payment_breakdown_kernel(amounts, company_rates, vat_rates, commissions, vats, nets, ties)
+
+    expected_commissions, commission_ties = kathib._round_cents(amounts * company_rates)
+    expected_vats, vat_ties = kathib._round_cents(expected_commissions * vat_rates)
+    expected_nets, net_ties = kathib._round_cents(amounts - expected_commissions - expected_vats)
+    np.testing.assert_array_equal(commissions, expected_commissions)
+    np.testing.assert_array_equal(vats, expected_vats)
+    np.testing.assert_array_equal(nets, expected_nets)
+    np.testing.assert_array_equal(ties, commission_ties | vat_ties | net_ties)
@@ -0,0 +1,54 @@
+import html
+import re
+from datetime import datetime, timedelta
+
+from conftest import BASE_URL, add_payment, kathib
+
+PAYMENT_ID_RE = re.compile(r"editPayment\('(\d+)'\)")
+
+
+def page_ids(response):
+    return [int(i) for i in PAYMENT_ID_RE.findall(response.get_data(as_text=True))]
+
+
+def page_link(response, label):
+    match = re.search(r'href="([^"]+)">' + label + '<', response.get_data(as_text=True))
+    return html.unescape(match.group(1)) if match else None
+
+
+def test_keyset_pages_cover_all_payments_in_order(client, login, unit):
+    login()
+    # Several payments share each timestamp, so the id tie-breaker decides the order
+    start = datetime(2024, 1, 1)
+    for i in range(23):
+        add_payment(unit, 100 + i, start + timedelta(days=i // 4))
+    kathib.db.session.commit()
+    expected = [p.id for p in kathib.Payment.query.order_by(kathib.Payment.date.desc(), kathib.Payment.id.desc())]
+
+    seen, pages = [], []
+    url = '/payments'
+    while url:
+        response = client.get(url, base_url=BASE_URL)
+        assert response.status_code == 200
+        pages.append(response)
+        seen.extend(page_ids(response))
+        url = page_link(response, 'التالي')
+
+    assert seen == expected
+    assert [len(page_ids(p)) for p in pages] == [10, 10, 3]
+    assert page_link(pages[0], 'السابق') is None
+
+    # Going back from the last page returns exactly the previous page
+    back = client.get(page_link(pages[-1], 'السابق'), base_url=BASE_URL)
+    assert page_ids(back) == page_ids(pages[1])
+
+
+def test_malformed_cursor_shows_first_page(client, login, unit):
+    login()
+    add_payment(unit, 100, datetime(2024, 1, 1))
+    kathib.db.session.commit()
+
+    for query in ('after_date=not-a-date&after_id=1', 'before_date=2024-13-45&before_id=1'):
+        response = client.get(f'/payments?{query}', base_url=BASE_URL)
+        assert response.status_code == 200
+        assert len(page_ids(response)) == 1
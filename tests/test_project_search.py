@@ -0,0 +1,16 @@
+from conftest import kathib
+
+
+def search_projects(term):
+    return kathib.Project.query.filter(kathib.project_search_text.contains(term)).all()
+
+
+def test_search_matches_within_a_single_field(app):
+    kathib.db.session.add(kathib.Project(name='برج الرياض', location='حي الملقا', description='شقق سكنية'))
+    kathib.db.session.commit()
+
+    assert len(search_projects('الرياض')) == 1
+    assert len(search_projects('الملقا')) == 1
+    assert len(search_projects('سكنية')) == 1
+    # The end of the name and the start of the location are not one phrase
+    assert search_projects('الرياض حي') == []